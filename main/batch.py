@@ -0,0 +1,136 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from geometry import build_device
+from results import RESULTS_FILE, write_results
+from usuki import B, simulate
+
+# Same defaults as the TransportSimulation widget
+DEFAULTS = {
+    "option": "Quantum Wire",
+    "wire": 4000.0,
+    "vdiag_val": 3.0,
+    "qpcgap": 1000.0,
+    "qpcheight": 300.0,
+    "n": 1,
+    "ymesh": 119,
+    "xmax": 4000,
+    "ymax": 7000,
+    "centered": False,
+    "frames": 200,
+    "emax": 0.0035,
+    "b": B,
+    "tol": None,
+    "checkpoint": None,
+    "batch": None,
+    "single": False,
+    "backend": "recursion",
+    "transmission_only": False,
+}
+
+# A manifest is a JSON object with optional "defaults" (overriding DEFAULTS), "sweep"
+# (parameter name -> list of values, expanded as a Cartesian product) and "runs"
+# (explicit configurations). Every configuration may carry a "name" for its bundle.
+EXAMPLE_MANIFEST = {
+    "defaults": {"option": "Quantum Point Contact", "frames": 100},
+    "sweep": {"qpcgap": [800.0, 1000.0, 1200.0], "qpcheight": [300.0, 500.0]},
+    "runs": [{"name": "double_dot", "option": "Quantum Dot", "n": 2}],
+}
+
+
+def expand_manifest(manifest):
+    base = dict(DEFAULTS, **manifest.get("defaults", {}))
+    configs = []
+    sweep = manifest.get("sweep", {})
+    if sweep:
+        keys = list(sweep)
+        for values in itertools.product(*(sweep[key] for key in keys)):
+            configs.append(dict(base, **dict(zip(keys, values))))
+    for run in manifest.get("runs", []):
+        configs.append(dict(base, **run))
+    if not configs:
+        configs.append(base)
+    for i, config in enumerate(configs):
+        config.setdefault("name", f"run_{i:03d}")
+    return configs
+
+
+def run_config(config, out_dir):
+    potential_vals = build_device(config["option"], config["wire"], config["qpcgap"], config["qpcheight"],
+                                  config["vdiag_val"], config["ymesh"], config["xmax"], config["ymax"],
+                                  config["n"], centered=config["centered"])
+    solver, energies, transmissions, densities = simulate(potential_vals, config["ymesh"], 0.0, config["xmax"],
+                                                          0.0, config["ymax"], config["frames"], config["emax"],
+                                                          b=config["b"], checkpoint=config["checkpoint"],
+                                                          tol=config["tol"], batch=config["batch"],
+                                                          single=config["single"], backend=config["backend"],
+                                                          transmission_only=config["transmission_only"])
+
+    bundle = os.path.join(out_dir, config["name"])
+    os.makedirs(bundle, exist_ok=True)
+    write_results(os.path.join(bundle, RESULTS_FILE), energies, transmissions, densities, solver.rows,
+                  solver.nsl, solver.bet, solver.b, solver.delx, solver.dely)
+    np.save(os.path.join(bundle, "potential.npy"), potential_vals)
+    with open(os.path.join(bundle, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+    return bundle
+
+
+def bundle_matches(config, out_dir):
+    # Default names are positional, so an existing bundle is only reused when it was made from this exact config
+    path = os.path.join(out_dir, config["name"], "config.json")
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        return json.load(f) == json.loads(json.dumps(config))
+
+
+def run_batch(configs, out_dir, workers=None, force=False):
+    workers = workers or os.cpu_count()
+    pending = [c for c in configs if force or not bundle_matches(c, out_dir)]
+    for config in configs:
+        if config not in pending:
+            print(f"skip {config['name']} (bundle exists)")
+
+    bundles = []
+    failed = []
+    # One configuration per process; each sweep runs serially inside its worker
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_config, config, out_dir): config for config in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]["name"]
+            try:
+                bundles.append(future.result())
+                print(f"[{done}/{len(pending)}] {name} done")
+            except Exception as e:
+                print(f"[{done}/{len(pending)}] {name} failed: {e}")
+                failed.append(name)
+    return bundles, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a sweep manifest of Usuki transport simulations.")
+    parser.add_argument("manifest", nargs="?", help="JSON sweep manifest")
+    parser.add_argument("--out", default="results", help="directory for the per-configuration bundles")
+    parser.add_argument("--workers", type=int, default=None, help="parallel runs (default: all cores)")
+    parser.add_argument("--force", action="store_true", help="recompute bundles that already exist")
+    parser.add_argument("--example", action="store_true", help="print an example manifest and exit")
+    args = parser.parse_args(argv)
+
+    if args.example or not args.manifest:
+        print(json.dumps(EXAMPLE_MANIFEST, indent=2))
+        return 0
+
+    with open(args.manifest) as f:
+        configs = expand_manifest(json.load(f))
+    os.makedirs(args.out, exist_ok=True)
+    _, failed = run_batch(configs, args.out, args.workers, args.force)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
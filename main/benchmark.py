@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from batch import DEFAULTS
+from geometry import build_device
+from outputs import FrameRenderer, frame_density
+from results import density_percentile, write_results
+import usuki
+from usuki import UsukiSolver, energy_grid, write_text_results
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+PHASES = ["lead", "recursion", "backward", "output", "render"]
+
+# Reference devices, each run at every (ymesh, frames) size of the chosen suite
+DEVICES = {
+    "wire": ("Quantum Wire", None),
+    "qpc": ("Quantum Point Contact", None),
+    "dot1": ("Quantum Dot", 1),
+    "dot3": ("Quantum Dot", 3),
+}
+SUITES = {
+    "quick": [(29, 10)],
+    "standard": [(29, 20), (59, 20), (59, 50), (119, 50)],
+}
+
+# A phase is a regression when it is slower than the baseline by more than the relative
+# tolerance and by more than MIN_SECONDS, so timer noise on tiny phases is ignored
+TIME_TOLERANCE = 0.25
+MEMORY_TOLERANCE = 0.10
+MIN_SECONDS = 0.05
+# Physics invariants: flux conservation nprop = trans + ref at every open energy, and
+# perfect transmission through a wire with no potential at all
+UNITARITY_TOL = 1e-6
+CLEAN_WIRE_TOL = 1e-6
+# Largest transmission or relative density difference allowed between the solver backends, and
+# between the parity split and the full solve
+BACKEND_TOL = 1e-8
+
+
+def make_cases(suite, devices=None):
+    cases = []
+    for ymesh, frames in SUITES[suite]:
+        for device in devices or DEVICES:
+            option, n = DEVICES[device]
+            cases.append({"name": f"{device}_y{ymesh}_f{frames}", "option": option, "n": n,
+                          "ymesh": ymesh, "frames": frames})
+    return cases
+
+
+def _solver(potential_vals, ymesh, transmission_only=False, backend="recursion", parity=True):
+    return UsukiSolver(potential_vals, ymesh, 0.0, DEFAULTS["xmax"], 0.0, DEFAULTS["ymax"], b=DEFAULTS["b"],
+                       transmission_only=transmission_only, backend=backend, parity=parity)
+
+
+def _device(case, centered=False):
+    return build_device(case["option"], DEFAULTS["wire"], DEFAULTS["qpcgap"], DEFAULTS["qpcheight"],
+                        DEFAULTS["vdiag_val"], case["ymesh"], DEFAULTS["xmax"], DEFAULTS["ymax"], case["n"],
+                        centered=centered)
+
+
+def run_phases(case, render_frames):
+    potential_vals = _device(case)
+    energies = energy_grid(DEFAULTS["emax"], case["frames"])
+    solver = _solver(potential_vals, case["ymesh"])
+    results = solver._solve_chunk(energies)
+    phases = solver.instrument.timings
+    timings = {"lead": phases["lead"], "recursion": phases["forward"] + phases["final"],
+               "backward": phases["backward"]}
+    transmissions, densities = solver._collect(results)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        write_results(os.path.join(tmp, "transport.usk"), energies, transmissions, densities, solver.rows,
+                      solver.nsl, solver.bet, solver.b, solver.delx, solver.dely)
+        write_text_results(os.path.join(tmp, "tr_b.txt"), os.path.join(tmp, "waves.txt"), energies, solver.bet,
+                           transmissions, densities)
+        timings["output"] = time.perf_counter() - start
+
+    # Rendering is reported per frame; the one-off figure setup is excluded
+    cmax, zmax = density_percentile(densities, 95)
+    renderer = FrameRenderer(energies, transmissions, solver.rows, solver.nsl + 1, 0, cmax, zmax)
+    count = min(render_frames, len(energies))
+    start = time.perf_counter()
+    for frame in range(count):
+        renderer.render(frame, frame_density(densities, frame))
+    timings["render"] = (time.perf_counter() - start) / max(count, 1)
+
+    unitarity = max((abs(r["unitarity"]) for r in solver.instrument.records if r["nprop"] >= 1), default=0.0)
+    return timings, unitarity
+
+
+def run_case(case, repeat=1, render_frames=3):
+    # Timings are the best of the repeats; peak memory comes from one extra traced run
+    timings = None
+    for _ in range(repeat):
+        run, unitarity = run_phases(case, render_frames)
+        timings = run if timings is None else {phase: min(timings[phase], run[phase]) for phase in PHASES}
+    tracemalloc.start()
+    run_phases(case, render_frames)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"timings": timings, "total": sum(timings.values()), "peak_mb": peak / 1024**2,
+            "unitarity": unitarity}
+
+
+def clean_wire_error(ymesh, frames):
+    potential_vals = build_device("Quantum Wire", DEFAULTS["wire"], DEFAULTS["qpcgap"], DEFAULTS["qpcheight"],
+                                  0.0, ymesh, DEFAULTS["xmax"], DEFAULTS["ymax"])
+    solver = _solver(potential_vals, ymesh, transmission_only=True)
+    results = solver._solve_chunk(energy_grid(DEFAULTS["emax"], frames))
+    return max((abs(trans - nprop) for nprop, trans, _, _ in results if nprop >= 1), default=0.0)
+
+
+def backend_error(case):
+    # The sparse LU backend must reproduce the slice recursion
+    potential_vals = _device(case)
+    energies = energy_grid(DEFAULTS["emax"], case["frames"])
+    t0, d0 = _solver(potential_vals, case["ymesh"]).sweep(energies)
+    t1, d1 = _solver(potential_vals, case["ymesh"], backend="sparse").sweep(energies)
+    return max(np.abs(t1 - t0).max(), (np.abs(d1 - d0) / d0.max()).max())
+
+
+def parity_error(case):
+    # On a centred mesh the reference devices are mirror-symmetric, and the even/odd split must
+    # reproduce the full solve
+    potential_vals = _device(case, centered=True)
+    energies = energy_grid(DEFAULTS["emax"], case["frames"])
+    split = _solver(potential_vals, case["ymesh"])
+    if split.parity_blocks is None:
+        return np.inf
+    t0, d0 = _solver(potential_vals, case["ymesh"], parity=False).sweep(energies)
+    t1, d1 = split.sweep(energies)
+    return max(np.abs(t1 - t0).max(), (np.abs(d1 - d0) / d0.max()).max())
+
+
+def compare(name, result, baseline, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    failures = []
+    if result["unitarity"] > UNITARITY_TOL:
+        failures.append(f"{name}: unitarity error {result['unitarity']:.2e} exceeds {UNITARITY_TOL:.0e}")
+    reference = baseline.get(name)
+    if reference is None:
+        return failures
+    for phase in PHASES:
+        now, then = result["timings"][phase], reference["timings"][phase]
+        if now > then * (1 + time_tolerance) and now - then > MIN_SECONDS:
+            failures.append(f"{name}: {phase} took {now:.3f}s against a baseline of {then:.3f}s")
+    if result["peak_mb"] > reference["peak_mb"] * (1 + memory_tolerance):
+        failures.append(f"{name}: peak memory {result['peak_mb']:.1f} MB against a baseline of "
+                        f"{reference['peak_mb']:.1f} MB")
+    return failures
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)["cases"]
+
+
+def save_baseline(path, results):
+    # Merge into the existing baseline so suites can be recorded separately
+    cases = load_baseline(path)
+    cases.update(results)
+    with open(path, "w") as f:
+        json.dump({"cases": cases}, f, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Usuki solver and frame renderer.")
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick", help="set of mesh sizes and frame counts")
+    parser.add_argument("--devices", nargs="+", choices=list(DEVICES), help="reference devices to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case; the fastest is kept")
+    parser.add_argument("--render-frames", type=int, default=3, help="frames rendered per case")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help="record these results as the baseline")
+    parser.add_argument("--time-tolerance", type=float, default=TIME_TOLERANCE, help="allowed relative slowdown")
+    parser.add_argument("--memory-tolerance", type=float, default=MEMORY_TOLERANCE,
+                        help="allowed relative peak memory growth")
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline)
+    results = {}
+    failures = []
+    print(f"{'case':<18}" + "".join(f"{phase:>11}" for phase in PHASES) + f"{'total':>11}{'peak MB':>10}{'unitarity':>11}")
+    for case in make_cases(args.suite, args.devices):
+        result = run_case(case, args.repeat, args.render_frames)
+        results[case["name"]] = result
+        print(f"{case['name']:<18}" + "".join(f"{result['timings'][phase]:>11.3f}" for phase in PHASES)
+              + f"{result['total']:>11.3f}{result['peak_mb']:>10.1f}{result['unitarity']:>11.1e}")
+        failures += compare(case["name"], result, baseline, args.time_tolerance, args.memory_tolerance)
+        if usuki.sparse is not None:
+            error = backend_error(case)
+            if error > BACKEND_TOL:
+                failures.append(f"{case['name']}: sparse backend differs from the recursion by {error:.2e}")
+        error = parity_error(case)
+        if error > BACKEND_TOL:
+            failures.append(f"{case['name']}: parity split differs from the full solve by {error:.2e}")
+
+    for ymesh, frames in SUITES[args.suite]:
+        error = clean_wire_error(ymesh, frames)
+        print(f"clean wire y{ymesh} f{frames}: max |trans - nprop| = {error:.1e}")
+        if error > CLEAN_WIRE_TOL:
+            failures.append(f"clean wire y{ymesh} f{frames}: transmission is off the channel count by {error:.2e}")
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"baseline written to {args.baseline}")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import numpy as np
+import usuki
+from results import load_results, write_results
+
+CACHE_DIR = ".usuki_cache"
+MAX_BYTES = 2 * 1024**3
+# Bump when a solver change alters results so stale entries are never served
+CACHE_VERSION = 1
+
+
+def cache_key(potential_vals, params):
+    constants = {
+        "A": usuki.A, "EF0": usuki.EF0, "ALPHA": usuki.ALPHA, "M0": usuki.M0, "HBAR": usuki.HBAR,
+        "Q": usuki.Q, "MASS": usuki.MASS, "RMASS": usuki.RMASS, "ANGFAC": usuki.ANGFAC,
+    }
+    potential_vals = np.ascontiguousarray(potential_vals, dtype=np.float64)
+    h = hashlib.sha256()
+    h.update(json.dumps({"version": CACHE_VERSION, "constants": constants, "params": params,
+                         "shape": potential_vals.shape}, sort_keys=True).encode("utf-8"))
+    h.update(potential_vals.tobytes())
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.usk")
+
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        # Touch on hit so eviction sees the entry as recently used
+        os.utime(path)
+        return load_results(path)
+
+    def put(self, key, energies, transmissions, densities, rows, nsl, bet, b, delx, dely):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        write_results(tmp, energies, transmissions, densities, rows, nsl, bet, b, delx, dely)
+        os.replace(tmp, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".usk"):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".usk"):
+                    os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,80 @@
+import numpy as np
+
+DEVICES = ["Quantum Wire", "Quantum Point Contact", "Quantum Dot", "One-Sided Quantum Dot"]
+
+
+def device_mesh(ny, xmax, ymax, xmin=0.0, ymin=0.0):
+    dely = (ymax - ymin)/(ny + 1)
+    delx = dely
+    nx = int(xmax/delx)
+    return nx, delx, dely
+
+
+def mesh_coordinates(nx, ny, xmin, ymin, delx, dely, centered=False):
+    # Rows sit at ymin + iy*dely by default; centered rows at ymin + (iy+1)*dely lie symmetrically
+    # between the walls at ymin and ymin + (ny+1)*dely
+    ix, iy = np.meshgrid(np.arange(nx + 1), np.arange(ny), indexing='ij')
+    return xmin + delx * ix, ymin + dely * (iy + 1 if centered else iy)
+
+
+# Mask primitives, all evaluated over the whole mesh at once
+def between(v, lo, hi, inclusive=True):
+    if inclusive:
+        return (lo <= v) & (v <= hi)
+    return (lo < v) & (v < hi)
+
+
+def rectangle(x, y, x0, x1, y0, y1, inclusive=True):
+    return between(x, x0, x1, inclusive) & between(y, y0, y1, inclusive)
+
+
+def outside(v, lo, hi):
+    return (v <= lo) | (v >= hi)
+
+
+def dot_barriers(x, n, xmax, width):
+    # n + 1 barrier columns evenly spaced along the wire, bounding n dots
+    mask = np.zeros(x.shape, dtype=bool)
+    if n:
+        for center in [(i + 1) * xmax / (n + 2) for i in range(n + 1)]:
+            mask |= between(x, center - width / 2, center + width / 2)
+    return mask
+
+
+def barrier_mask(option, x, y, wire, qpcgap, qpcheight, xmax, ymin, ymax, n=None):
+    if option == "Quantum Wire":
+        return ~between(y, ymin + wire/2, ymax - wire/2, inclusive=False)
+
+    if option == "Quantum Dot":
+        walls = outside(y, (ymax - wire)/2, ymax - (ymax - wire)/2)
+        return walls | (dot_barriers(x, n, xmax, qpcheight) & outside(y, (ymax - qpcgap) / 2, (ymax + qpcgap) / 2))
+
+    if option == "One-Sided Quantum Dot":
+        walls = outside(y, (ymax - wire)/2, ymax - (ymax - wire)/2)
+        side = between(y, (ymax - wire)/2 + qpcgap, ymax - (ymax - wire)/2)
+        return walls | (dot_barriers(x, n, xmax, qpcheight) & side)
+
+    # Quantum Point Contact
+    x0, x1 = (xmax - qpcheight) / 2, (xmax + qpcheight) / 2
+    gap = rectangle(x, y, x0, x1, (ymax - qpcgap) / 2, (ymax + qpcgap) / 2)
+    leads = ~between(x, x0, x1) & between(y, (ymax - wire)/2, ymax - (ymax - wire)/2)
+    return ~(gap | leads)
+
+
+def build_potential(option, nx, ny, xmin, xmax, ymin, ymax, delx, dely, wire, qpcgap, qpcheight,
+                    vdiag_val, n=None, centered=False):
+    x, y = mesh_coordinates(nx, ny, xmin, ymin, delx, dely, centered)
+    mask = barrier_mask(option, x, y, wire, qpcgap, qpcheight, xmax, ymin, ymax, n)
+    return np.where(mask, vdiag_val, 0.0)
+
+
+def build_device(option, wire, qpcgap, qpcheight, vdiag_val, ny, xmax, ymax, n=None, xmin=0.0, ymin=0.0,
+                 centered=False):
+    nx, delx, dely = device_mesh(ny, xmax, ymax, xmin, ymin)
+    return build_potential(option, nx, ny, xmin, xmax, ymin, ymax, delx, dely, wire, qpcgap, qpcheight,
+                           vdiag_val, n, centered)
+
+
+def write_fort45(path, x_grid, y_grid, potential_vals):
+    table = np.column_stack([x_grid.ravel(), y_grid.ravel(), potential_vals.ravel()])
+    np.savetxt(path, table, fmt="%.6f")
@@ -1,16 +1,34 @@
 import numpy as np
-import math
-import cmath
 import time
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import plotly.graph_objects as go
 from ipywidgets import (
-    FloatText, Button, Dropdown, VBox, HBox, Output, IntText, Layout, Tab
+    FloatText, Button, Dropdown, VBox, HBox, Output, IntText, Layout, Tab, Checkbox, Image, SelectionSlider
 )
+from usuki import B, RecursionCache, potential_columns, simulate, write_text_results
+from cache import ResultCache, cache_key
+from journal import SweepJournal
+from instrument import Instrument
+from results import RESULTS_FILE, write_results
+from outputs import FrameViewer, load_frames
+from geometry import DEVICES, device_mesh, build_potential, write_fort45
+
+# Most mesh points sent to the browser for the potential preview
+PREVIEW_POINTS = 20000
+
+
+def decimate(n, stride):
+    # Every stride-th index, always keeping the last one so the preview spans the whole device
+    idx = np.arange(0, n, stride)
+    return idx if idx[-1] == n - 1 else np.append(idx, n - 1)
+
+
 class TransportSimulation:
     def __init__(self):
         self.option_input = Dropdown(
-            options=["Quantum Wire", "Quantum Point Contact", "Quantum Dot", "One-Sided Quantum Dot"],
+            options=DEVICES,
             description="Type:",
             value="Quantum Wire"
         )
@@ -26,36 +44,97 @@ class TransportSimulation:
         self.ymesh_input = IntText(value=119, description="Mesh (Y):", layout=Layout(width='150px'))
         self.xmax_input = IntText(value=4000, description="X Axis:", layout=Layout(width='150px'))
         self.ymax_input = IntText(value=7000, description="Y Axis:", layout=Layout(width='150px'))
+        # Rows centred between the walls keep symmetric devices mirror-symmetric on the mesh, which
+        # lets zero-field sweeps split into even and odd halves
+        self.centered_input = Checkbox(value=False, description="Centered Mesh")
         
         self.frames_input = IntText(value=200, description="Frames:", layout=Layout(width='150px'))
         self.emax_input = FloatText(value=0.0035, description="Max Energy:", layout=Layout(width='160px'))
+        self.workers_input = IntText(value=1, description="Workers:", layout=Layout(width='150px'))
+        self.checkpoint_input = IntText(value=0, description="Checkpoint:", layout=Layout(width='150px'))
+        self.batch_input = IntText(value=1, description="Batch:", layout=Layout(width='150px'))
+        self.sweep_input = Dropdown(options=["Uniform", "Adaptive"], value="Uniform",
+                                    description="Sweep:", layout=Layout(width='200px'))
+        self.tol_input = FloatText(value=0.05, description="Tolerance:", layout=Layout(width='150px'))
+        self.cache_input = Checkbox(value=True, description="Use Cache")
+        self.trans_only_input = Checkbox(value=False, description="Transmission Only")
+        self.reuse_input = Checkbox(value=True, description="Reuse Slices")
+        self.resume_input = Checkbox(value=True, description="Resume")
+        self.single_input = Checkbox(value=False, description="Single Precision")
+        self.backend_input = Dropdown(options=[("Recursion", "recursion"), ("Sparse LU", "sparse")], value="recursion",
+                                      description="Backend:", layout=Layout(width='200px'))
+        self.format_input = Dropdown(options=["Binary", "Text", "Binary + Text"], value="Binary",
+                                     description="Output:", layout=Layout(width='200px'))
+
+        self.preview_input = Dropdown(options=[("3D Surface", "surface"), ("2D Heatmap", "heatmap")], value="surface",
+                                      description="Preview:", layout=Layout(width='200px'))
+        self.preview_points_input = IntText(value=PREVIEW_POINTS, description="Max Points:", layout=Layout(width='180px'))
 
         self.submit_button = Button(description="Generate Plot", button_style='primary')
         self.simulate_button = Button(description="View Transport", button_style='success')
         self.simulate_button.layout.display = 'none'
+        self.cancel_button = Button(description="Cancel", button_style='danger')
+        self.cancel_button.layout.display = 'none'
+        self.frames_button = Button(description="View Frames", button_style='info')
+        self.frames_button.layout.display = 'none'
+
+        # Transmission vs energy, filled in as energies finish in the background
+        self.trans_plot = go.FigureWidget(go.Scatter(x=[], y=[], mode='lines+markers', marker=dict(size=4)))
+        self.trans_plot.update_layout(title="Transmission vs Energy", xaxis_title="Energy",
+                                      yaxis_title="Transmission", width=700, height=350)
+        self.trans_box = VBox([self.trans_plot])
+        self.trans_box.layout.display = 'none'
+
+        # Potential preview, updated in place on every "Generate Plot" with at most preview_points_input points
+        self.potential_plot = go.FigureWidget()
+        self.potential_plot.update_layout(title="3D Potential Distribution", width=700, height=600)
+        self.potential_box = VBox([self.potential_plot])
+        self.potential_box.layout.display = 'none'
+
+        # Density frames of the last run, rendered one at a time as the energy slider moves
+        self.frame_slider = SelectionSlider(options=[("-", 0)], description="Energy:", continuous_update=False,
+                                            layout=Layout(width='700px'))
+        self.frame_image = Image(format='png')
+        self.viewer_box = VBox([self.frame_slider, self.frame_image])
+        self.viewer_box.layout.display = 'none'
+        self.viewer = None
 
         self.output = Output()
 
         self.option_input.observe(self.on_option_change, names='value')
         self.submit_button.on_click(self.generate_plot)
         self.simulate_button.on_click(self.run_simulation)
+        self.cancel_button.on_click(self.cancel_simulation)
+        self.frames_button.on_click(self.view_frames)
+        self.frame_slider.observe(self.show_frame, names='value')
 
         tabs = Tab(children=[
             VBox([HBox([self.option_input, self.wire_input, self.vdiag_val_input, self.qpcgap_input, 
                         self.qpcheight_input, self.n_input], 
                        layout=Layout(align_items='center'))]),
-            VBox([HBox([self.xmax_input, self.ymax_input, self.ymesh_input])]),
-            VBox([HBox([self.frames_input, self.emax_input])])
+            VBox([HBox([self.xmax_input, self.ymax_input, self.ymesh_input, self.centered_input]),
+                  HBox([self.preview_input, self.preview_points_input])]),
+            VBox([HBox([self.frames_input, self.emax_input, self.workers_input, self.checkpoint_input, self.format_input]),
+                  HBox([self.sweep_input, self.tol_input, self.batch_input, self.cache_input, self.trans_only_input,
+                        self.reuse_input, self.resume_input, self.single_input, self.backend_input])])
         ])
         tabs.set_title(0, "Geometry")
         tabs.set_title(1, "Axis Sizes")
         tabs.set_title(2, "Output Specifics")
 
-        self.layout = VBox([tabs, self.submit_button, self.simulate_button, self.output])
+        self.layout = VBox([tabs, self.submit_button, self.potential_box,
+                            HBox([self.simulate_button, self.cancel_button, self.frames_button]), self.trans_box,
+                            self.viewer_box, self.output])
 
         self.potential_vals = None
         self.nx = None
         self.ny = None
+        self.cache = ResultCache()
+        # Lead modes and slice states of earlier runs, so a geometry edit only recomputes from the first changed column
+        self.recursion_cache = RecursionCache()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.cancel_event = threading.Event()
 
     def on_option_change(self, change):
         self.qpcgap_input.layout.display = '' if change.new in ["Quantum Point Contact", "Quantum Dot", "One-Sided Quantum Dot"] else 'none'
@@ -77,16 +156,14 @@ class TransportSimulation:
         self.emax = emax
         n = self.n_input.value if self.option_input.value in ["Quantum Dot", "One-Sided Quantum Dot"] else None
 
-        self.update_plot(option, wire, qpcgap, qpcheight, vdiag_val, ny, xmax, ymax, n)
+        self.update_plot(option, wire, qpcgap, qpcheight, vdiag_val, ny, xmax, ymax, n, self.centered_input.value)
 
         self.simulate_button.layout.display = ''
 
-    def update_plot(self, option, wire, qpcgap, qpcheight, vdiag_val, ny, xmax, ymax, n=None):
+    def update_plot(self, option, wire, qpcgap, qpcheight, vdiag_val, ny, xmax, ymax, n=None, centered=False):
         xmin, xmax = 0.0, xmax
         ymin, ymax = 0.0, ymax
-        dely = (ymax - ymin)/(ny + 1)
-        delx = dely
-        nx = int(xmax/delx)
+        nx, delx, dely = device_mesh(ny, xmax, ymax, xmin, ymin)
         
         self.nx = nx
         self.ny = ny
@@ -95,56 +172,8 @@ class TransportSimulation:
         self.ymin = ymin
         self.xmin = xmin
         
-        def quantum_wire(ix, iy):
-            x, y = xmin + delx * ix, ymin + dely * iy
-            if ymin + wire/2 < y < ymax - wire/2:
-                return 0.0
-            else:
-                return vdiag_val
-        
-        def vdiag_qpc(ix, iy):
-            x, y = xmin + delx * ix, ymin + dely * iy
-            if (xmax - qpcheight) / 2 <= x <= (xmax + qpcheight) / 2:
-                if (ymax - qpcgap) / 2 <= y <= (ymax + qpcgap) / 2:
-                    return 0.0
-            elif (ymax - wire)/2 <= y <= ymax - (ymax - wire)/2:
-                return 0.0
-            return vdiag_val
-
-        def vdiag_dot(ix, iy):
-            x, y = xmin + delx * ix, ymin + dely * iy
-            centers = [(i + 1) * xmax / (n + 2) for i in range(n + 1)] if n else []
-            for center in centers:
-                if ((center - qpcheight / 2 <= x <= center + qpcheight / 2) and
-                    (y <= (ymax - qpcgap) / 2 or y >= (ymax + qpcgap) / 2)):
-                    return vdiag_val
-            if y <= (ymax - wire)/2 or y >= ymax - (ymax - wire)/2:
-                return vdiag_val
-            return 0.0
-
-        def vdiag_one_sided_dot(ix, iy):
-            x, y = xmin + delx * ix, ymin + dely * iy
-            centers = [(i + 1) * xmax / (n + 2) for i in range(n + 1)] if n else []
-            for center in centers:
-                if ((center - qpcheight / 2 <= x <= center + qpcheight / 2) and
-                    ((ymax - wire)/2 + qpcgap <= y <= ymax - (ymax - wire)/2)):
-                    return vdiag_val
-            if y <= (ymax - wire)/2 or y >= ymax - (ymax - wire)/2:
-                return vdiag_val
-            return 0.0
-                    
-
-        vdiag_func = {
-            "Quantum Point Contact": vdiag_qpc,
-            "Quantum Dot": vdiag_dot,
-            "One-Sided Quantum Dot": vdiag_one_sided_dot,
-            "Quantum Wire" : quantum_wire
-        }.get(option, vdiag_qpc)
-
-        self.potential_vals = np.zeros((nx + 1, ny))
-        for ix in range(nx + 1):
-            for iy in range(ny):
-                self.potential_vals[ix, iy] = vdiag_func(ix, iy)
+        self.potential_vals = build_potential(option, nx, ny, xmin, xmax, ymin, ymax, delx, dely, wire,
+                                              qpcgap, qpcheight, vdiag_val, n, centered)
 
         with self.output:
             print(f"Potential array shape: {self.potential_vals.shape}")
@@ -153,51 +182,60 @@ class TransportSimulation:
         y_vals = np.linspace(ymin, ymax, ny)
         x_grid, y_grid = np.meshgrid(x_vals, y_vals, indexing='ij')
 
-        with open("fort.45", "w") as f:
-            for ix in range(nx + 1):
-                for iy in range(ny):
-                    f.write(f"{x_grid[ix, iy]:.6f} {y_grid[ix, iy]:.6f} {self.potential_vals[ix, iy]:.6f}\n")
-
-        x_range = xmax - xmin
-        z_range = self.potential_vals.max() - self.potential_vals.min()
-        aspect_ratio = dict(
-            x=x_range/4000,
-            y=1,
-            z=0.15*z_range
-        )
-        fig = go.Figure(data=[
-            go.Surface(
-                z=self.potential_vals,
-                x=x_grid,
-                y=y_grid,
-                colorscale='Viridis',
-                colorbar=dict(title="Potential")
-            )
-        ])
-        fig.update_layout(
-            title="3D Potential Distribution",
-            scene=dict(
-                xaxis_title="X-axis",
-                yaxis_title="Y-axis",
-                zaxis_title="Potential",
-                aspectratio=aspect_ratio,
-            ),
-            width=700,
-            height=600,
-        )
-        with self.output:
-            self.output.clear_output(wait=True)
-            fig.show()
+        write_fort45("fort.45", x_grid, y_grid, self.potential_vals)
+
+        self.plot_potential(x_vals, y_vals)
+        self.potential_box.layout.display = ''
+
+    def plot_potential(self, x_vals, y_vals):
+        # Only a strided subset of the mesh goes to the browser, with x and y as 1D axes rather
+        # than full grids; the same trace is updated in place unless the preview type changed
+        budget = max(self.preview_points_input.value, 4)
+        stride = max(1, int(np.ceil(np.sqrt(self.potential_vals.size / budget))))
+        ix, iy = decimate(len(x_vals), stride), decimate(len(y_vals), stride)
+        z = self.potential_vals[np.ix_(ix, iy)].T
+        kind = self.preview_input.value
+        fig = self.potential_plot
+        with fig.batch_update():
+            if not fig.data or fig.data[0].type != kind:
+                fig.data = []
+                if kind == "surface":
+                    fig.add_trace(go.Surface(colorscale='Viridis', colorbar=dict(title="Potential")))
+                else:
+                    fig.add_trace(go.Heatmap(colorscale='Viridis', colorbar=dict(title="Potential")))
+            fig.data[0].x = x_vals[ix]
+            fig.data[0].y = y_vals[iy]
+            fig.data[0].z = z
+            title = "3D Potential Distribution" if kind == "surface" else "Potential Distribution"
+            if stride > 1:
+                title += f" (1 in {stride} points per axis)"
+            fig.layout.title.text = title
+            if kind == "surface":
+                x_range = x_vals[-1] - x_vals[0]
+                z_range = self.potential_vals.max() - self.potential_vals.min()
+                fig.layout.scene = dict(xaxis_title="X-axis", yaxis_title="Y-axis", zaxis_title="Potential",
+                                        aspectratio=dict(x=x_range/4000, y=1, z=0.15*z_range))
+            else:
+                fig.layout.xaxis.title.text = "X-axis"
+                fig.layout.yaxis.title.text = "Y-axis"
+
+    def log(self, message):
+        # Safe to call from the background thread, unlike printing inside "with self.output"
+        self.output.append_stdout(message + "\n")
 
     def run_simulation(self, b):
         if self.potential_vals is None:
             with self.output:
                 print("Please generate a potential plot first.")
                 return
+        if self.future is not None and not self.future.done():
+            self.log("A simulation is already running.")
+            return
 
-        with self.output:
-            print("Running transport simulation...")
-            
+        self.log("Running transport simulation...")
+
+        # The sweep keeps this potential even if the geometry is regenerated while it runs
+        potential_vals = self.potential_vals
         ny = self.ny
         xmin = self.xmin
         ymin = self.ymin
@@ -205,373 +243,163 @@ class TransportSimulation:
         ymax = self.ymax
         frames = self.frames
         emax = self.emax
-
+        workers = self.workers_input.value
+        checkpoint = self.checkpoint_input.value or None
+        batch = max(1, self.batch_input.value)
+        output_format = self.format_input.value
+        tol = self.tol_input.value if self.sweep_input.value == "Adaptive" else None
+        use_cache = self.cache_input.value
+        transmission_only = self.trans_only_input.value
+        single = self.single_input.value
+        backend = self.backend_input.value
+        recursion_cache = self.recursion_cache if self.reuse_input.value else None
+        resume = self.resume_input.value
+
+        self.plot_transmission([], [])
+        self.trans_box.layout.display = ''
+        # The output files are about to be replaced, so the last run's frames go too
+        self.transmission_only = transmission_only
+        self.viewer = None
+        self.viewer_box.layout.display = 'none'
+        self.frames_button.layout.display = 'none'
+        self.cancel_event.clear()
+        self.cancel_button.disabled = False
+        self.cancel_button.layout.display = ''
+        self.simulate_button.disabled = True
+
+        # The sweep runs on a background thread so the kernel stays responsive
+        self.future = self.executor.submit(self.run_usuki_simulation, potential_vals, ny, xmin, xmax, ymin, ymax,
+                                           frames, emax, workers=workers, checkpoint=checkpoint,
+                                           output_format=output_format, tol=tol, use_cache=use_cache,
+                                           transmission_only=transmission_only, progress=self.live_progress(),
+                                           batch=batch, single=single, backend=backend,
+                                           recursion_cache=recursion_cache, resume=resume)
+        self.future.add_done_callback(self.simulation_done)
+
+    def live_progress(self):
+        # Redraw the transmission plot at most every 0.25 s; closed energies carry no transmission
+        points = []
+        last = [0.0]
+
+        def progress(done, total, record):
+            if record["nprop"] >= 1:
+                points.append((record["energy"], record["trans"]))
+            now = time.monotonic()
+            if now - last[0] < 0.25 and done != total:
+                return
+            last[0] = now
+            x, y = zip(*sorted(points)) if points else ((), ())
+            self.plot_transmission(x, y, f"Transmission vs Energy ({done}/{total})")
+        return progress
+
+    def plot_transmission(self, energies, transmissions, title="Transmission vs Energy"):
+        with self.trans_plot.batch_update():
+            self.trans_plot.data[0].x = energies
+            self.trans_plot.data[0].y = transmissions
+            self.trans_plot.layout.title.text = title
+
+    def cancel_simulation(self, b):
+        self.cancel_event.set()
+        self.cancel_button.disabled = True
+        self.log("Cancelling after the energies in progress...")
+
+    def simulation_done(self, future):
+        self.simulate_button.disabled = False
+        self.cancel_button.layout.display = 'none'
         try:
-            self.run_usuki_simulation(ny, xmin, xmax, ymin, ymax, frames, emax)
-
-            with self.output:
-                if os.path.exists("tr_b.txt"):
-                    with open("tr_b.txt", "r") as f:
-                        lines = f.readlines()
-                        print(f"tr_b.txt length: {len(lines)}")
-
-                print("Simulation complete. Ouput files saved to tr_b.txt and waves.txt")
-
+            files, completed, cancelled = future.result()
         except Exception as e:
-            with self.output:
-                print(f"Error during simulation: {e}")
-
-    def run_usuki_simulation(self, ny, xmin, xmax, ymin, ymax, frames, emax):
+            self.log(f"Error during simulation: {e}")
+            self.log("Energies solved so far are kept; run again with Resume checked to continue.")
+            return
+        if os.path.exists("tr_b.txt"):
+            with open("tr_b.txt", "r") as f:
+                lines = f.readlines()
+                self.log(f"tr_b.txt length: {len(lines)}")
+        if completed and not self.transmission_only:
+            self.frames_button.layout.display = ''
+        if cancelled:
+            self.log(f"Simulation cancelled after {completed} energies. "
+                     f"Partial results saved to {' and '.join(files)}; run again with Resume checked to continue.")
+        else:
+            self.log(f"Simulation complete. Ouput files saved to {' and '.join(files)}")
+
+    def view_frames(self, b):
+        # Frames are read and rendered only as the slider reaches them
+        densities, energy, transmission = load_frames()
+        self.viewer = FrameViewer(densities, energy, transmission)
+        self.frame_slider.options = [(f"{e:.6f}", frame) for frame, e in enumerate(energy)]
+        self.frame_slider.value = 0
+        self.show_frame()
+        self.viewer_box.layout.display = ''
+
+    def show_frame(self, change=None):
+        if self.viewer is not None:
+            self.frame_image.value = self.viewer.png(self.frame_slider.value)
+
+    def run_usuki_simulation(self, potential_vals, ny, xmin, xmax, ymin, ymax, frames, emax, workers=1,
+                             checkpoint=None, output_format="Binary", tol=None, use_cache=False, transmission_only=False,
+                             progress=None, batch=1, single=False, backend="recursion", recursion_cache=None,
+                             resume=True):
 
         if os.path.exists("waves.txt"): os.remove("waves.txt")
         if os.path.exists("tr_b.txt"): os.remove("tr_b.txt")
-
-        # Constants
-        rows = ny
-        cols = 68
-        islmax = 300
-        a = 2.50e-9  # Grid size
-        b = 0.000    # Magnetic field in Tesla
-        EF0 = 0.014338  # Fermi energy in eV
-        alpha = 68.214  # Spreading factor in nm/V
-
-        # Derived Constants
-        m0 = 9.10938356e-31  # Electron mass (kg)
-        hbar = 1.0545718e-34  # Reduced Planck constant (J·s)
-        q = 1.602176634e-19   # Elementary charge (C)
-        mass = 0.45 * m0
-        rmass = .067
-        angfac=0.2626*rmass
-        hb2o2m = (hbar / (2 * mass)) * (hbar / q)
-        ci = 1j
-        c1 = complex(1.0, 0.0)
-        c0 = complex(0.0, 0.0)
-
-        #thop = hb2o2m / (a ** 2)
-        xmin=xmin
-        xmax=xmax
-        ymin=ymin
-        ymax=ymax
-        dely=(ymax-ymin)/(rows+1)
-        delx=dely
-        thop =1.0/(delx*delx*angfac)
-        nsl=int(xmax/delx)
-        # nsl should be used instead of cols
-
-        emax=emax
-        emin=0.00
-        ne=frames + 1
-        de=(emax-emin)/(ne-1)
-
-        bet = q * b * (a ** 2) / hbar
-
-        # Matrices and arrays
-        #pot = np.zeros((rows, nsl), dtype=np.float64)
-        vel = np.zeros(rows)
-        psil = np.zeros(rows)
-        pot = np.full((nsl+1, rows), 3)
-        for i in range(min(nsl + 1, self.potential_vals.shape[0])):
-            for j in range(min(rows, self.potential_vals.shape[1])):
-                pot[i, j] = self.potential_vals[i, j]
-        np.savetxt("potentials.txt", pot, fmt="%.6f")
-        evec = np.zeros((rows, rows), dtype=np.complex128)
-        up = np.zeros((rows, rows), dtype=np.complex128)
-        upl = np.zeros((rows, rows), dtype=np.complex128)
-        um = np.zeros((rows, rows), dtype=np.complex128)
-        uml = np.zeros((rows, rows), dtype=np.complex128)
-        c1l1 = np.zeros((rows, rows), dtype=np.complex128)
-        c2l1 = np.zeros((rows, rows), dtype=np.complex128)
-        d1l1 = np.zeros((rows, rows), dtype=np.complex128)
-        d2l1 = np.zeros((rows, rows), dtype=np.complex128)
-        p2i = np.zeros((rows, rows), dtype=np.complex128)
-        evs = np.zeros(rows, dtype=np.complex128)
-        T21 = np.zeros((rows, rows), dtype=np.complex128)
-        T22 = np.zeros((rows, rows), dtype=np.complex128)
-        Tl = np.zeros((2*rows, 2*rows), dtype=np.complex128)  # Initialize Tl with c0
-        pl1 = np.zeros((rows, rows, islmax), dtype=np.complex128)
-        pl2 = np.zeros((rows, rows, islmax), dtype=np.complex128)
-        pl2i = np.zeros((rows, rows, islmax), dtype=np.complex128)
-        psimode = np.zeros((islmax, rows, rows), dtype=np.complex128)
-        psipm = np.zeros((islmax, rows), dtype=np.double)
-        phi1new = np.zeros((rows, rows), dtype=np.complex128)
-        phi2new = np.zeros((rows, rows), dtype=np.complex128)
-        phi1old = np.zeros((rows, rows), dtype=np.complex128)
-        phi2old = np.zeros((rows, rows), dtype=np.complex128)
-
-        # energy loop
-        trans = 0.0
-        #for ef in range(30,31):
-        for ef in range(1,ne):
-
-            en=emin+ef*de
-            ehop=en/thop
-
-            # Propagation through columns
-            for i in range(rows):
-                # Note: Fortran is 1-based; Python is 0-based
-                Pmi = -np.exp(ci * bet)
-                Pmi1 = -np.exp(ci * bet)
-                # Zero the i-th row
-                T21[i, :] = c0
-                T22[i, :] = c0
-                # Diagonal entry of T21
-                T21[i, i] = -Pmi * Pmi1
-                # Diagonal entry of T22 with complex potential
-                T22[i, i] = (ehop - 4.0 - (pot[0, i] )/thop) * Pmi
-                # Off-diagonal entries of T22
-                if i < rows - 1:
-                    T22[i, i + 1] = -Pmi
-                if i > 0:
-                    T22[i, i - 1] = -Pmi
-
-            for i in range(rows):
-                Tl[i, i + rows] = c1
-                Tl[i + rows, i] = T21[i, i]
-                for j in range(rows):
-                    Tl[i + rows, j + rows] = T22[i, j]
-
-            evals, evec = np.linalg.eig(Tl)
-        # Preallocate arrays
-            xp = np.zeros(rows)
-            xpe = np.zeros(rows)
-            xm = np.zeros(rows)
-            xme = np.zeros(rows)
-
-            ipv = np.zeros(rows, dtype=int)
-            ipev = np.zeros(rows, dtype=int)
-            imv = np.zeros(rows, dtype=int)
-            imev = np.zeros(rows, dtype=int)
-
-            rnorm = np.zeros(2*rows)
-            cur = np.zeros(2*rows)
-
-            im = ip = ime = ipe = 0
-            nprop2 = 0
-
-        # Compute rnorm
-            for j in range(2*rows):
-                rnorm[j] = sum(abs(evec[i, j])**2 for i in range(rows))
-
-        # Loop through all eigenvalues
-            for j in range(2*rows):
-                x = abs(evals[j])
-
-                if 0.9999 < x < 1.0001:
-                    nprop2 += 1
-                    rk = (cmath.log(evals[j] ) / complex(0.0, 1.0)).real
-                    rnorm[j] = 0.0
-                    cur[j] = 0.0
-
-                    for i in range(rows):
-                        add = abs(evec[i, j])
-                        cur[j] += math.sin(rk + 2.0 * math.pi * bet * (i + 1)) * add ** 2
-                        rnorm[j] += add ** 2
-
-                    vf = cur[j] / rnorm[j] if rnorm[j] != 0 else 0.0
-
-                    if vf > 0.0:
-                        ipv[ip] = j
-                        xp[ip] = rk
-                        ip += 1
-                    else:
-                        imv[im] = j
-                        xm[im] = rk
-                        im += 1
-
-                elif x < 0.9999:
-                    ipev[ipe] = j
-                    xpe[ipe] = x
-                    ipe += 1
-                    rnorm[j] = sum(abs(evec[i, j])**2 for i in range(rows))
-
-                elif x > 1.0001:
-                    imev[ime] = j
-                    xme[ime] = x
-                    ime += 1
-                    rnorm[j] = sum(abs(evec[i, j])**2 for i in range(rows))
-
-        # Final value
-            nprop = nprop2 // 2
-            print("ip,ipe,im,ime",ip,ipe,im,ime)
-
-        # Sort xp/ipv ascending
-            if ip > 1:
-                sorted_indices = np.argsort(xp[:ip])
-                xp[:ip] = xp[sorted_indices]
-                ipv[:ip] = ipv[sorted_indices]
-
-        # Sort xm/imv descending
-            if im > 1:
-                sorted_indices = np.argsort(-xm[:im])
-                xm[:im] = xm[sorted_indices]
-                imv[:im] = imv[sorted_indices]
-
-            for j in range(ip):
-                idx = ipv[j]
-                vel[j] = cur[idx] / rnorm[idx]
-
-                rkval = xp[j] / dely
-                evalp = ehop * thop - (rkval) ** 2.0 / angfac
-                abs_eval_diff = abs(evals[idx]) - 1.0
-
-                for i in range(rows):
-                    up[i, j] = evec[i, idx] / np.sqrt(delx * delx * rnorm[idx])
-                    upl[i, j] = evec[i + rows, idx] / np.sqrt(delx * delx * rnorm[idx])
-
-            # Evanescent positive modes
-            for j in range(ipe):
-                idx = ipev[j]
-                for i in range(rows):
-                    up[i, j + ip] = evec[i, idx] / np.sqrt(delx * delx * rnorm[idx])
-                    upl[i, j + ip] = evec[i + rows, idx] / np.sqrt(delx * delx * rnorm[idx])
-
-            # Negative propagating modes
-            for j in range(im):
-                idx = imv[j]
-                for i in range(rows):
-                    um[i, j] = evec[i, idx] / np.sqrt(delx * delx * rnorm[idx])
-                    uml[i, j] = evec[i + rows, idx] / np.sqrt(delx * delx * rnorm[idx])
-
-            # Evanescent negative modes
-            for j in range(ime):
-                idx = imev[j]
-                for i in range(rows):
-                    um[i, j + im] = evec[i, idx] / np.sqrt(delx * delx * rnorm[idx])
-                    uml[i, j + im] = evec[i + rows, idx] / np.sqrt(delx * delx * rnorm[idx])
-
-            print(en,nprop)
-            #print(um(:,range(im)))
-            if nprop >= 1:
-                d2l1 = np.linalg.inv(uml)
-                c2l1 = um @ d2l1
-                p2i = np.linalg.inv(c2l1)
-                d1l1 = -d2l1 @ upl
-                c1l1 = up - c2l1 @ upl
-                iii = 0
-                for ii in range(0, nsl+1):  
-                    istart = ii
-                    if istart >= 0:
-                        iii += 1
-
-            # Copy matrices
-                    c1l = c1l1.copy()
-                    c2l = c2l1.copy()
-                    d1l = d1l1.copy()
-                    d2l = d2l1.copy()
-
-                    if istart >= 0:
-                        pl1[:, :, iii - 1] = c1l1
-                        pl2[:, :, iii - 1] = c2l1
-                        pl2i[:, :, iii - 1] = p2i
-
-                    for i in range(rows):
-                        Pmi = -np.exp(ci * bet)
-                        Pmi1 = -np.exp(ci * bet)
-                        T21[i, :] = c0
-                        T22[i, :] = c0
-                        T21[i, i] = -Pmi * Pmi1
-                        T22[i, i] = (ehop - 4.0 - (pot[ii, i] )) * Pmi
-                        if i < rows - 1:
-                            T22[i, i + 1] = -Pmi
-                        if i > 0:
-                            T22[i, i - 1] = -Pmi
-                    save = np.diag(T21)[:, np.newaxis] * c2l  
-                    p2i = save + T22
-                    c2l1 = np.linalg.inv(p2i)
-                    save = np.diag(T21)[:, np.newaxis] * c1l 
-                    save2 = c2l1 @ save                     
-                    c1l1 = -save2                          
-                    d2l1 = d2l @ c2l1
-                    save = d2l @ c1l1
-                    d1l1 = d1l + save
-
-                c1l = c1l1.copy()
-                c2l = c2l1.copy()
-                d1l = d1l1.copy()
-                d2l = d2l1.copy()
-                pl1[:, :, nsl + 1] = c1l1
-                pl2[:, :, nsl + 1] = c2l1
-                pl2i[:, :, nsl + 1] = p2i
-                # final slice
-                upli = np.linalg.inv(upl)
-                save = up @ upli
-                save2 = c2l - save
-                p2 = np.linalg.inv(save2)
-                save2 = p2 @ c1l
-                p1 = -save2
-                save = upli @ save2
-                c1l1 = -save
-                save = d2l @ save2
-                d1l1 = d1l - save
-                pl1[:, :, nsl + 2] = p1
-                pl2[:, :, nsl + 2] = p2
-                pl2i[:, :, nsl + 2] = p2i
-
-                trans = 0.0
-                ref = 0.0
-
-                for j in range(nprop):
-                    for i in range(nprop):
-                        term = (vel[i] / vel[j]) * abs(c1l1[i, j])**2
-                        trans += term
-                        ref += (vel[i] / vel[j]) * abs(d1l1[i, j])**2
-
-                corrinel = (float(nprop) - (trans + ref)) / 2.0
-
-                print('e,bmag,trans,ref,error')
-                print(en, bet, trans, ref,float(nprop) - trans - ref)
-
-                phi1new[:, :] = c0
-                phi2new[:, :] = c0
-                np.fill_diagonal(phi2new, c1)
-                ii = nsl + 1
-                phi1old[:, :] = phi1new
-                phi2old[:, :] = phi2new
-                p1[:, :] = pl1[:, :, ii + 1]
-                p2[:, :] = pl2[:, :, ii + 1]
-                phi2new = phi2old @ p2
-                save = phi2old @ p1
-                phi1new = phi1old + save
-
-                nslice = 0
-
-                # Backward propagation
-                for lplot in range(nsl + 1, 0, -1):
-                    nslice += 1
-                    p2[:, :] = pl2[:, :, lplot]
-                    p1[:, :] = pl1[:, :, lplot]
-                    phi1old[:, :] = phi1new
-
-                    save = p2 @ phi1old
-                    phi1new = p1 + save
-                    phi1old[:, :] = phi1new
-
-                    for m in range(rows):
-                        for i in range(nprop):
-                            psimode[lplot, m, i] = phi1new[m, i]
-
-                # Accumulate probabilities
-                for lplot in range(1, nsl + 2):  # Fortran 1 to nsl+1
-                    for m in range(rows):
-                        psil[m] = 0.0
-                        psipm[lplot, m] = 0.0
-                        for i in range(nprop):
-                            amp2 = abs(psimode[lplot, m, i])**2
-                            psil[m] += amp2
-                            psipm[lplot, m] += amp2
-
-            ttot = trans
-
-            with open("tr_b.txt", "a") as trb:
-                trb.write(f"{en:.8e} {bet:.8e} {ttot:.8e}\n")
-
-            with open("waves.txt", "a") as wvs:
-                for lplot in range(1, nsl + 2):  
-                    for m in range(rows):
-                        if psipm[lplot, m] < 1e-10:
-                            psipm[lplot, m] = 1e-10
-
-                        wvs.write(f"{psipm[lplot, m]:.8e} \n")
-
-app = TransportSimulation()
-app.layout
+        if os.path.exists(RESULTS_FILE): os.remove(RESULTS_FILE)
+
+        params = {"ny": ny, "xmin": float(xmin), "xmax": float(xmax), "ymin": float(ymin), "ymax": float(ymax),
+                  "frames": frames, "emax": emax, "tol": tol, "b": B, "transmission_only": transmission_only}
+        # Single-precision results differ slightly, so they are cached separately; the sparse
+        # backend ignores single
+        if single and backend == "recursion":
+            params["single"] = True
+        if backend != "recursion":
+            params["backend"] = backend
+        key = cache_key(potential_vals, params)
+        cached = self.cache.get(key) if use_cache else None
+        if cached is not None:
+            header, table, densities = cached
+            energies, transmissions = table[:, 0], table[:, 2]
+            if transmission_only:
+                densities = None
+            rows, nsl, bet, b, delx, dely = (header[k] for k in ("rows", "nsl", "bet", "b", "delx", "dely"))
+            self.log("Loaded cached results.")
+            cancelled = False
+        else:
+            # Every solved batch is journaled under the same key, so an interrupted or cancelled
+            # sweep picks up where it stopped the next time it is run
+            journal = SweepJournal(key)
+            if not resume:
+                journal.clear()
+            elif len(journal):
+                self.log(f"Resuming: {len(journal)} energies already solved.")
+            instrument = Instrument(progress=progress)
+            solver, energies, transmissions, densities = simulate(potential_vals, ny, xmin, xmax, ymin, ymax,
+                                                                  frames, emax, workers=workers,
+                                                                  checkpoint=checkpoint, tol=tol,
+                                                                  transmission_only=transmission_only,
+                                                                  instrument=instrument, cancel=self.cancel_event,
+                                                                  batch=batch, single=single, backend=backend,
+                                                                  recursion_cache=recursion_cache, journal=journal)
+            rows, nsl, bet, b, delx, dely = solver.rows, solver.nsl, solver.bet, solver.b, solver.delx, solver.dely
+            cancelled = solver.cancelled()
+            # Partial sweeps from a cancelled run are written out but never cached
+            if use_cache and not cancelled:
+                self.cache.put(key, energies, transmissions, densities, rows, nsl, bet, b, delx, dely)
+        self.plot_transmission(np.asarray(energies), np.asarray(transmissions))
+        np.savetxt("potentials.txt", potential_columns(potential_vals, nsl, rows), fmt="%.6f")
+
+        files = []
+        if output_format in ("Binary", "Binary + Text"):
+            write_results(RESULTS_FILE, energies, transmissions, densities, rows, nsl, bet, b, delx, dely)
+            files.append(RESULTS_FILE)
+        if output_format in ("Text", "Binary + Text"):
+            write_text_results("tr_b.txt", "waves.txt", energies, bet, transmissions, densities)
+            files.extend(["tr_b.txt"] if densities is None else ["tr_b.txt", "waves.txt"])
+        if cached is None and not cancelled:
+            journal.clear()
+        return files, len(energies), cancelled
+
+if __name__ == "__main__":
+    from IPython.display import display
+    app = TransportSimulation()
+    display(app.layout)
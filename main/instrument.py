@@ -0,0 +1,60 @@
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger("usuki")
+
+
+class Instrument:
+    # Wall time and call counts per solver phase, free-form counters and one record per solved
+    # energy. Nothing is printed: per-energy lines go to the "usuki" logger at DEBUG level, so
+    # they only appear once logging is configured, e.g. logging.basicConfig(level=logging.DEBUG)
+    def __init__(self, timer=time.perf_counter, progress=None):
+        self.timer = timer
+        # Called as progress(done, total, record) after every solved energy
+        self.progress = progress
+        self.total = None
+        self.timings = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.records = []
+
+    @contextmanager
+    def phase(self, name):
+        start = self.timer()
+        try:
+            yield
+        finally:
+            self.timings[name] += self.timer() - start
+            self.calls[name] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def record(self, **fields):
+        self.records.append(fields)
+        logger.debug("e=%.8e nprop=%d trans=%.8f ref=%.8f error=%.2e wall=%.4fs", fields["energy"],
+                     fields["nprop"], fields["trans"], fields["ref"], fields["unitarity"], fields["wall"])
+        if self.progress is not None:
+            self.progress(len(self.records), self.total, fields)
+
+    def state(self):
+        return dict(self.timings), dict(self.calls), dict(self.counters), self.records
+
+    def merge(self, state):
+        # Fold in what a worker process collected, replaying its records through the hooks here
+        timings, calls, counters, records = state
+        for name, seconds in timings.items():
+            self.timings[name] += seconds
+        for name, n in calls.items():
+            self.calls[name] += n
+        for name, n in counters.items():
+            self.counters[name] += n
+        for fields in records:
+            self.record(**fields)
+
+    def summary(self):
+        lines = [f"{name:<10} {self.timings[name]:10.4f}s  {self.calls[name]:6d} calls" for name in self.timings]
+        lines += [f"{name:<10} {n:10d}" for name, n in self.counters.items()]
+        return "\n".join(lines)
@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+import numpy as np
+
+JOURNAL_DIR = ".usuki_sweeps"
+MANIFEST = "manifest.json"
+JOURNAL_VERSION = 1
+
+
+class SweepJournal:
+    # Results of one sweep saved batch by batch so an interrupted sweep can be resumed. Every
+    # batch goes to its own .npz part and the manifest lists each part with the energies it
+    # holds; both are written to a temporary file and renamed, so a crash never leaves a torn
+    # entry behind. Parts missing from the manifest are ignored and later overwritten
+    def __init__(self, key, directory=JOURNAL_DIR):
+        self.path = os.path.join(directory, key)
+        self.parts = []
+        self.results = {}
+        manifest = os.path.join(self.path, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                manifest = json.load(f)
+            if manifest["version"] == JOURNAL_VERSION:
+                for part in manifest["parts"]:
+                    self._load(part["file"])
+                    self.parts.append(part)
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, en):
+        return self.results.get(float(en))
+
+    def _load(self, name):
+        with np.load(os.path.join(self.path, name)) as part:
+            densities = iter(part["density"]) if "density" in part else iter(())
+            for en, nprop, trans, ref, has_density in zip(part["energies"], part["nprop"], part["trans"],
+                                                          part["ref"], part["has_density"]):
+                density = next(densities) if has_density else None
+                self.results[float(en)] = (int(nprop), float(trans), float(ref), density)
+
+    def _replace(self, name, write):
+        tmp = os.path.join(self.path, f"{name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def record(self, energies, results):
+        os.makedirs(self.path, exist_ok=True)
+        energies = [float(en) for en in energies]
+        name = f"part_{len(self.parts):05d}.npz"
+        arrays = {
+            "energies": np.array(energies),
+            "nprop": np.array([nprop for nprop, _, _, _ in results], dtype=np.int64),
+            "trans": np.array([trans for _, trans, _, _ in results], dtype=float),
+            "ref": np.array([ref for _, _, ref, _ in results], dtype=float),
+            "has_density": np.array([density is not None for *_, density in results]),
+        }
+        densities = [density for *_, density in results if density is not None]
+        if densities:
+            arrays["density"] = np.stack(densities)
+        self._replace(name, lambda f: np.savez(f, **arrays))
+        self.parts.append({"file": name, "energies": energies})
+        manifest = json.dumps({"version": JOURNAL_VERSION, "parts": self.parts}).encode("utf-8")
+        self._replace(MANIFEST, lambda f: f.write(manifest))
+        self.results.update(zip(energies, results))
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        self.parts = []
+        self.results = {}
@@ -1,162 +1,230 @@
 import numpy as np
 import os
-import seaborn as sns
-import matplotlib.pyplot as plt
-from PIL import Image
+import argparse
+from collections import OrderedDict, deque
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.ticker as ticker
 import cv2
 import imageio
-
-frames_folder = "frames"
-os.makedirs(frames_folder, exist_ok=True)
-w = np.loadtxt("waves.txt")
-t = np.loadtxt("tr_b.txt")
-energy = t[:, 0]
-transmission = t[:, 2]
-total_frames = 199 #link variable (this is ne from prev code)
-rows = 119 #link variable (this is rows from prev code)
-nsl = 69 #link variable (this is nsl + 1 from prev code)
-
-all_values = []
-for frame in range(total_frames):
-    w2 = np.zeros((rows, nsl))
-    for i in range(nsl):
-        for j in range(rows):
-            w2[j, i] = w[nsl * rows * frame + i * rows + j]
-    all_values.append(w2.flatten())
-
-all_values = np.concatenate(all_values)
-cmin = 0
-cmax = np.percentile(all_values, 95)
-
-filenames_combined = []
-
-for frame in range(total_frames):
-    w2 = np.zeros((rows, nsl))
-    for i in range(nsl):
-        for j in range(rows):
-            w2[j, i] = w[nsl * rows * frame + i * rows + j]
-
-    x = np.arange(nsl)
-    y = np.arange(rows)
-    X, Y = np.meshgrid(x, y)
-
-    fig_3D = plt.figure(figsize=(5, 2.5))
-    ax = fig_3D.add_subplot(121, projection='3d')
-
-    surf = ax.plot_surface(X, Y, w2, cmap='jet', vmin=cmin, vmax=cmax, alpha=0.9, rstride=3, cstride=3)
-
-    ax.set_title(f"Frame {frame + 1} - 3D View", fontsize=8)
-    ax.set_xlabel("X Axis", fontsize=6, labelpad=8)
-    ax.set_ylabel("Y Axis", fontsize=6, labelpad=8)
-    ax.set_zlabel("Wave Amplitude", fontsize=6, labelpad=10)
-    ax.tick_params(axis='both', labelsize=6)
-    ax.w_zaxis.set_major_formatter(ticker.FuncFormatter(lambda x, _: f'{x:.1e}'))
-    ax.view_init(elev=30, azim=150)
-    local_cmax = np.max(w2)
-    ax.set_zticks(np.linspace(0, local_cmax, 6))
-    ax.tick_params(axis='z', pad=6, labelsize=6)
-    ax.set_box_aspect([1, 1.5, 0.5])
-
-    filename_3D = os.path.join(frames_folder, f"temp_3D_{frame:03d}.png")
-    plt.tight_layout()
-    plt.savefig(filename_3D, dpi=150, bbox_inches='tight')
-    plt.close(fig_3D)
-
-    fig_top = plt.figure(figsize=(5, 2.5), facecolor = 'white')
-    ax = fig_top.add_subplot(122)
-    sns.heatmap(w2, xticklabels=False, yticklabels=False, cmap='jet', cbar_kws={'label': 'Wave Amplitude', 'ticks': np.linspace(cmin, cmax, 5), 'format': '%.1e'}, vmin=cmin, vmax=cmax)
-    
-    colorbar = ax.collections[0].colorbar
-    colorbar.ax.tick_params(labelsize=6)
-    colorbar.set_label('Wave Amplitude', fontsize=6)
-    
-    ny, nx = w2.shape
-    x_ticks = np.linspace(0, nx-nx%10, int(nx/10) + 1)
-    y_ticks = np.linspace(0, ny-ny%40, int(ny/40) + 1)
-    ax.set_xticks(x_ticks)
-    ax.set_yticks(y_ticks)
-    ax.tick_params(axis='both', labelsize=6)
-    
-    ax.set_title(f"Frame {frame + 1} - Top View", fontsize=8)
-    ax.set_xlabel("X Axis", fontsize=6, labelpad=8)
-    ax.set_ylabel("Y Axis", fontsize=6, labelpad=8)
-    ax.xaxis.set_major_formatter(ticker.ScalarFormatter())
-    ax.yaxis.set_major_formatter(ticker.ScalarFormatter())
-
-    filename_top = os.path.join(frames_folder, f"temp_top_{frame:03d}.png")
-    plt.tight_layout()
-    plt.savefig(filename_top, dpi=150, bbox_inches='tight')
-    plt.close(fig_top)
-    
-    fig_trans = plt.figure(figsize=(4, 2.5), facecolor='white')
-    ax_trans = fig_trans.add_subplot(111)
-    sns.lineplot(x=energy, y=transmission, ax=ax_trans, color='blue', linewidth=1)
-    ax_trans.axvline(x=energy[frame], color='red', linestyle='--', linewidth=1)
-
-    ax_trans.set_title("Transmission vs Energy", fontsize=8)
-    ax_trans.set_xlabel("Energy", fontsize=6, labelpad=8)
-    ax_trans.set_ylabel("Transmission", fontsize=6, labelpad=8)
-    ax_trans.tick_params(axis='x', labelsize=6)
-    ax_trans.tick_params(axis='y', labelsize=6)
- 
-    transmission_filename = os.path.join(frames_folder, f"temp_transmission_{frame:03d}.png")
-    plt.tight_layout()
-    plt.savefig(transmission_filename, dpi=150, bbox_inches='tight')
-    plt.close(fig_trans)
-
-    img_3D = Image.open(filename_3D)
-    img_top = Image.open(filename_top)
-    img_transmission = Image.open(transmission_filename)
-
-    combined_height = img_3D.height
-    aspect_ratio_3D = img_3D.width / img_3D.height
-    aspect_ratio_top = img_top.width / img_top.height
-    aspect_ratio_transmission = img_transmission.width / img_transmission.height
-    
-    new_width_3D = int(combined_height * aspect_ratio_3D)
-    new_width_top = int(combined_height * aspect_ratio_top)
-    new_width_transmission = int(combined_height * aspect_ratio_transmission)
-    
-    img_3D = img_3D.resize((new_width_3D, combined_height))
-    img_top = img_top.resize((new_width_top, combined_height))
-    img_transmission = img_transmission.resize((new_width_transmission, combined_height))
-
-    combined_width = img_3D.width + img_top.width + img_transmission.width - 10
-    combined_img = Image.new("RGB", (combined_width, combined_height))
-    combined_img.paste(img_3D, (0, 0))
-    combined_img.paste(img_top, (img_3D.width - 5, 0))
-    combined_img.paste(img_transmission, (img_3D.width + img_top.width - 10, 0))
-
-    filename_combined = os.path.join(frames_folder, f"frame_combined_{frame:03d}.png")
-    combined_img.save(filename_combined)
-    filenames_combined.append(filename_combined)
-
-    os.remove(filename_3D)
-    os.remove(filename_top)
-    os.remove(transmission_filename)
-
-#GIF
-frames = "frames"
-output_gif = "wire_electron_density.gif" #adjust name as needed
-frame_paths = [os.path.join(frames, f"frame_combined_{str(i).zfill(3)}.png") for i in range(total_frames)]
-with imageio.get_writer(output_gif, mode='I', duration=0.1) as writer:
-    for frame_path in frame_paths:
-        image = imageio.imread(frame_path)
-        writer.append_data(image)
-
-#MP4
-img = cv2.imread(filenames_combined[0])
-height, width, layers = img.shape
-video_filename = "wire_electron_density.mp4" #adjust name as needed
-fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-video_writer = cv2.VideoWriter(video_filename, fourcc, 10, (width, height))
-for filename in filenames_combined:
-    img = cv2.imread(filename)
-    video_writer.write(img)
-video_writer.release()
-
-#Clean up
-for filename in filenames_combined:
-    os.remove(filename)
-os.rmdir(frames_folder)
+from concurrent.futures import ProcessPoolExecutor
+from results import RESULTS_FILE, density_percentile, load_results, load_text_densities
+
+def load_frames():
+    # Densities come back as a (frames, nsl, rows) view: memory-mapped straight from the binary
+    # results, or filled chunk by chunk from the text output
+    if os.path.exists(RESULTS_FILE):
+        header, t, densities = load_results(RESULTS_FILE)
+        if header["columns"] == 0:
+            raise SystemExit(f"{RESULTS_FILE} was written in transmission-only mode and holds no densities")
+    else:
+        t = np.loadtxt("tr_b.txt", ndmin=2)
+        total_frames = len(t)
+        if os.path.exists("potentials.txt"):
+            nsl, rows = np.loadtxt("potentials.txt", ndmin=2).shape
+        else:
+            rows = 119 #link variable (this is rows from prev code)
+            nsl = 69 #link variable (this is nsl + 1 from prev code)
+        densities = load_text_densities("waves.txt", total_frames, nsl, rows)
+    energy = t[:, 0]
+    transmission = t[:, 2]
+    return densities, energy, transmission
+
+
+def frame_density(densities, frame):
+    return densities[frame].T
+
+
+class FrameRenderer:
+    # One composite figure built once; each frame only swaps the surface, the heatmap data,
+    # the energy marker and the titles, drawn over a cached background of the static artists
+    def __init__(self, energy, transmission, rows, nsl, cmin, cmax, zmax):
+        self.rows = rows
+        self.nsl = nsl
+        self.cmin = cmin
+        self.cmax = cmax
+        self.energy = energy
+        self.fig = Figure(figsize=(11, 2.6), dpi=150, facecolor='white')
+        self.canvas = FigureCanvasAgg(self.fig)
+        grid = self.fig.add_gridspec(1, 3, width_ratios=[1.0, 1.15, 1.1], wspace=0.35,
+                                     left=0.02, right=0.98, bottom=0.2, top=0.88)
+
+        x = np.arange(nsl)
+        y = np.arange(rows)
+        self.X, self.Y = np.meshgrid(x, y)
+
+        ax = self.fig.add_subplot(grid[0], projection='3d')
+        self.title_3D = ax.set_title("", fontsize=8)
+        ax.set_xlabel("X Axis", fontsize=6, labelpad=8)
+        ax.set_ylabel("Y Axis", fontsize=6, labelpad=8)
+        ax.set_zlabel("Wave Amplitude", fontsize=6, labelpad=10)
+        ax.tick_params(axis='both', labelsize=6)
+        ax.zaxis.set_major_formatter(ticker.FuncFormatter(lambda x, _: f'{x:.1e}'))
+        ax.view_init(elev=30, azim=150)
+        # The z range is fixed across frames so the axes can stay in the cached background
+        ax.set_xlim(0, nsl - 1)
+        ax.set_ylim(0, rows - 1)
+        ax.set_zlim(0, zmax)
+        ax.set_zticks(np.linspace(0, zmax, 6))
+        ax.tick_params(axis='z', pad=6, labelsize=6)
+        ax.set_box_aspect([1, 1.5, 0.5])
+        self.ax_3D = ax
+        self.surf = None
+
+        ax = self.fig.add_subplot(grid[1])
+        self.image = ax.imshow(np.zeros((rows, nsl)), cmap='jet', vmin=cmin, vmax=cmax, aspect='auto',
+                               interpolation='nearest', extent=(0, nsl, rows, 0))
+        colorbar = self.fig.colorbar(self.image, ax=ax, ticks=np.linspace(cmin, cmax, 5), format='%.1e')
+        colorbar.ax.tick_params(labelsize=6)
+        colorbar.set_label('Wave Amplitude', fontsize=6)
+        ax.set_xticks(np.linspace(0, nsl-nsl%10, int(nsl/10) + 1))
+        ax.set_yticks(np.linspace(0, rows-rows%40, int(rows/40) + 1))
+        ax.tick_params(axis='both', labelsize=6)
+        self.title_top = ax.set_title("", fontsize=8)
+        ax.set_xlabel("X Axis", fontsize=6, labelpad=8)
+        ax.set_ylabel("Y Axis", fontsize=6, labelpad=8)
+        ax.xaxis.set_major_formatter(ticker.ScalarFormatter())
+        ax.yaxis.set_major_formatter(ticker.ScalarFormatter())
+        self.ax_top = ax
+
+        ax = self.fig.add_subplot(grid[2])
+        ax.plot(energy, transmission, color='blue', linewidth=1)
+        self.marker = ax.axvline(x=energy[0], color='red', linestyle='--', linewidth=1)
+        ax.set_title("Transmission vs Energy", fontsize=8)
+        ax.set_xlabel("Energy", fontsize=6, labelpad=8)
+        ax.set_ylabel("Transmission", fontsize=6, labelpad=8)
+        ax.tick_params(axis='x', labelsize=6)
+        ax.tick_params(axis='y', labelsize=6)
+        self.ax_trans = ax
+
+        for artist in (self.title_3D, self.image, self.title_top, self.marker):
+            artist.set_animated(True)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    def render(self, frame, w2):
+        self.canvas.restore_region(self.background)
+
+        if self.surf is not None:
+            self.surf.remove()
+        self.surf = self.ax_3D.plot_surface(self.X, self.Y, w2, cmap='jet', vmin=self.cmin, vmax=self.cmax,
+                                            alpha=0.9, rstride=3, cstride=3, animated=True)
+        # Padding vertices of the masked surface faces overflow harmlessly under the fixed z scale
+        with np.errstate(over='ignore'):
+            self.surf.do_3d_projection()
+        self.ax_3D.draw_artist(self.surf)
+        self.title_3D.set_text(f"Frame {frame + 1} - 3D View")
+        self.ax_3D.draw_artist(self.title_3D)
+
+        self.image.set_data(w2)
+        self.ax_top.draw_artist(self.image)
+        self.title_top.set_text(f"Frame {frame + 1} - Top View")
+        self.ax_top.draw_artist(self.title_top)
+
+        self.marker.set_xdata([self.energy[frame], self.energy[frame]])
+        self.ax_trans.draw_artist(self.marker)
+
+        return np.asarray(self.canvas.buffer_rgba())[:, :, :3].copy()
+
+
+class FrameViewer:
+    # Renders single frames on demand for interactive viewing, reading only that frame's densities
+    # (a memmap slice for binary results) and keeping the most recently viewed frames
+    def __init__(self, densities, energy, transmission, cmin=0, cmax=None, zmax=None, cache_size=16, sample=16):
+        self.densities = densities
+        self.energy = energy
+        if cmax is None or zmax is None:
+            # The colour and z scales come from a few evenly spaced frames rather than a full pass
+            step = -(-len(densities) // sample)
+            cmax, zmax = density_percentile(densities[::step], 95)
+        _, nsl, rows = densities.shape
+        self.renderer = FrameRenderer(energy, transmission, rows, nsl, cmin, cmax, zmax)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def frame(self, frame):
+        if frame in self.cache:
+            self.cache.move_to_end(frame)
+            return self.cache[frame]
+        image = self.renderer.render(frame, frame_density(self.densities, frame))
+        self.cache[frame] = image
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return image
+
+    def png(self, frame):
+        return cv2.imencode(".png", cv2.cvtColor(self.frame(frame), cv2.COLOR_RGB2BGR))[1].tobytes()
+
+
+_renderer = None
+
+
+def _init_worker(*renderer_args):
+    # Each worker process builds and keeps its own figure
+    global _renderer
+    _renderer = FrameRenderer(*renderer_args)
+
+
+def _render_task(args):
+    return _renderer.render(*args)
+
+
+def iter_frames(densities, energy, transmission, cmin, cmax, zmax, workers=1):
+    total_frames, nsl, rows = densities.shape
+    renderer_args = (energy, transmission, rows, nsl, cmin, cmax, zmax)
+    tasks = ((frame, frame_density(densities, frame)) for frame in range(total_frames))
+    if workers is None or workers <= 1:
+        renderer = FrameRenderer(*renderer_args)
+        for task in tasks:
+            yield renderer.render(*task)
+        return
+    # At most 2 x workers frames are in flight, so neither the pickled densities nor the finished
+    # RGB frames pile up ahead of the encoder; frames come back in order
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=renderer_args) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(_render_task, task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_animation(frames, formats=("gif", "mp4"), output_gif="wire_electron_density.gif",
+                    video_filename="wire_electron_density.mp4", fps=10):
+    # Every RGB frame goes to each requested encoder as it is rendered; nothing touches disk in between
+    gif_writer = imageio.get_writer(output_gif, mode='I', duration=1.0 / fps) if "gif" in formats else None
+    video_writer = None
+    try:
+        for image in frames:
+            if gif_writer is not None:
+                gif_writer.append_data(image)
+            if "mp4" in formats:
+                if video_writer is None:
+                    height, width, layers = image.shape
+                    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                    video_writer = cv2.VideoWriter(video_filename, fourcc, fps, (width, height))
+                video_writer.write(cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    finally:
+        if gif_writer is not None:
+            gif_writer.close()
+        if video_writer is not None:
+            video_writer.release()
+
+
+def main(workers=1, formats=("gif", "mp4")):
+    densities, energy, transmission = load_frames()
+
+    cmin = 0
+    cmax, zmax = density_percentile(densities, 95)
+
+    frames = iter_frames(densities, energy, transmission, cmin, cmax, zmax, workers)
+    write_animation(frames, formats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render transport results into a GIF and MP4.")
+    parser.add_argument("--workers", type=int, default=1, help="processes rendering frames in parallel")
+    parser.add_argument("--format", choices=["gif", "mp4", "both"], default="both", help="animation formats to write")
+    args, _ = parser.parse_known_args()
+    main(args.workers, ("gif", "mp4") if args.format == "both" else (args.format,))
@@ -0,0 +1,110 @@
+import itertools
+import json
+import numpy as np
+
+# Layout: 8-byte magic, little-endian uint64 header length, JSON header padded to
+# a 64-byte boundary, then the (ne, 3) transmission table [energy, bet, transmission]
+# followed by the (ne, columns, rows) densities, both as contiguous little-endian float64.
+MAGIC = b"USUKIRES"
+VERSION = 1
+ALIGN = 64
+RESULTS_FILE = "transport.usk"
+
+
+def write_results(path, energies, transmissions, densities, rows, nsl, bet, b, delx, dely):
+    energies = np.asarray(energies, dtype="<f8")
+    table = np.column_stack([energies, np.full(len(energies), bet), transmissions]).astype("<f8")
+    # Transmission-only sweeps are stored with zero density columns
+    if densities is None:
+        densities = np.zeros((len(energies), 0, rows))
+    densities = np.ascontiguousarray(densities, dtype="<f8")
+    header = {
+        "version": VERSION,
+        "rows": int(rows),
+        "nsl": int(nsl),
+        "columns": int(densities.shape[1]),
+        "ne": int(len(energies)),
+        "energies": energies.tolist(),
+        "bet": float(bet),
+        "b": float(b),
+        "delx": float(delx),
+        "dely": float(dely),
+        "dtype": "<f8",
+    }
+    text = json.dumps(header).encode("utf-8")
+    pad = -(len(MAGIC) + 8 + len(text)) % ALIGN
+    text += b" " * pad
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(text)).astype("<u8").tobytes())
+        f.write(text)
+        # Straight from the arrays, without an intermediate bytes copy of the densities
+        table.tofile(f)
+        densities.tofile(f)
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a transport results file")
+        length = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        header = json.loads(f.read(length).decode("utf-8"))
+    header["data_offset"] = len(MAGIC) + 8 + length
+    return header
+
+
+def load_results(path, mmap=True):
+    header = read_header(path)
+    ne, columns, rows = header["ne"], header["columns"], header["rows"]
+    offset = header["data_offset"]
+    table_bytes = ne * 3 * 8
+    if mmap:
+        table = np.memmap(path, dtype="<f8", mode="r", offset=offset, shape=(ne, 3))
+        densities = np.memmap(path, dtype="<f8", mode="r", offset=offset + table_bytes, shape=(ne, columns, rows))
+    else:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            table = np.fromfile(f, dtype="<f8", count=ne * 3).reshape(ne, 3)
+            densities = np.fromfile(f, dtype="<f8", count=ne * columns * rows).reshape(ne, columns, rows)
+    return header, table, densities
+
+
+def load_text_densities(waves_path, ne, columns, rows, chunk_lines=1 << 20):
+    # Parse waves.txt in fixed-size chunks straight into a single preallocated array
+    densities = np.empty(ne * columns * rows)
+    filled = 0
+    with open(waves_path) as f:
+        while filled < densities.size:
+            lines = list(itertools.islice(f, min(chunk_lines, densities.size - filled)))
+            if not lines:
+                break
+            values = np.array(" ".join(lines).split(), dtype=float)
+            densities[filled:filled + len(values)] = values
+            filled += len(values)
+    if filled != densities.size:
+        raise ValueError(f"{waves_path} holds {filled} values, expected {ne} x {columns} x {rows}")
+    return densities.reshape(ne, columns, rows)
+
+
+def density_percentile(densities, q, chunk_bytes=64 * 1024**2, bins=4096):
+    # Approximate percentile over (frames, columns, rows) without materializing a flat copy:
+    # one pass for the range, then two histogram passes that narrow down to the target bin
+    step = max(1, chunk_bytes // max(1, densities[0].nbytes))
+    chunks = lambda: (np.asarray(densities[i:i + step]) for i in range(0, len(densities), step))
+    ranges = [(chunk.min(), chunk.max()) for chunk in chunks()]
+    lo, hi = min(r[0] for r in ranges), max(r[1] for r in ranges)
+    vmax = hi
+    target = q / 100.0 * (densities.size - 1)
+    below = 0
+    for _ in range(2):
+        if hi <= lo:
+            break
+        counts = np.zeros(bins, dtype=np.int64)
+        for chunk in chunks():
+            counts += np.histogram(chunk, bins=bins, range=(lo, hi))[0]
+        cumulative = below + np.cumsum(counts)
+        k = min(int(np.searchsorted(cumulative, target, side='right')), bins - 1)
+        below = cumulative[k - 1] if k > 0 else below
+        width = (hi - lo) / bins
+        lo, hi = lo + k * width, lo + (k + 1) * width
+    return 0.5 * (lo + hi), vmax
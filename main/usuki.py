@@ -0,0 +1,718 @@
+import copy
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from instrument import Instrument
+
+try:
+    import scipy.sparse as sparse
+    from scipy.sparse.linalg import splu
+except ImportError:  # scipy is only needed for the sparse backend
+    sparse = None
+
+# Constants
+A = 2.50e-9  # Grid size
+B = 0.000    # Magnetic field in Tesla
+EF0 = 0.014338  # Fermi energy in eV
+ALPHA = 68.214  # Spreading factor in nm/V
+
+# Derived Constants
+M0 = 9.10938356e-31  # Electron mass (kg)
+HBAR = 1.0545718e-34  # Reduced Planck constant (J·s)
+Q = 1.602176634e-19   # Elementary charge (C)
+MASS = 0.45 * M0
+RMASS = .067
+ANGFAC = 0.2626*RMASS
+HB2O2M = (HBAR / (2 * MASS)) * (HBAR / Q)
+
+# Largest |nprop - trans - ref| accepted from a single-precision solve before it is redone in double
+SINGLE_TOL = 1e-4
+BACKENDS = ["recursion", "sparse"]
+RECURSION_CACHE_BYTES = 1024**3
+
+
+def energy_grid(emax, frames, emin=0.0):
+    ne = frames + 1
+    de = (emax - emin)/(ne - 1)
+    return np.array([emin + ef*de for ef in range(1, ne)])
+
+
+def potential_columns(potential_vals, nsl, rows):
+    pot = np.full((nsl+1, rows), 3)
+    nx = min(nsl + 1, potential_vals.shape[0])
+    ny = min(rows, potential_vals.shape[1])
+    pot[:nx, :ny] = potential_vals[:nx, :ny]
+    return pot
+
+
+def write_text_results(trb_path, waves_path, energies, bet, transmissions, densities):
+    table = np.column_stack([energies, np.full(len(energies), bet), transmissions])
+    np.savetxt(trb_path, table, fmt="%.8e")
+    if densities is not None:
+        np.savetxt(waves_path, densities.reshape(-1, 1), fmt="%.8e ")
+
+
+def simulate(potential_vals, ny, xmin, xmax, ymin, ymax, frames, emax, b=B, workers=1, checkpoint=None, tol=None,
+             transmission_only=False, instrument=None, cancel=None, batch=None, single=False, backend="recursion",
+             recursion_cache=None, journal=None):
+    solver = UsukiSolver(potential_vals, ny, xmin, xmax, ymin, ymax, b=b, checkpoint=checkpoint,
+                         transmission_only=transmission_only, instrument=instrument, cancel=cancel, batch=batch,
+                         single=single, backend=backend, recursion_cache=recursion_cache, journal=journal)
+    if tol is None:
+        energies = energy_grid(emax, frames)
+        transmissions, densities = solver.sweep(energies, workers=workers)
+        # A cancelled sweep returns only the energies completed so far
+        energies = energies[:len(transmissions)]
+    else:
+        energies, transmissions, densities = solver.adaptive_sweep(emax, frames, tol=tol, workers=workers)
+    return solver, energies, transmissions, densities
+
+
+def flush(m):
+    # In single precision, evanescent components decay into float32 subnormals that slow every
+    # later BLAS call by an order of magnitude. Entries below eps times their matrix's largest
+    # entry are under the rounding error of any product with it, so they are zeroed.
+    if m.dtype != np.complex64:
+        return m
+    parts = m.view(np.float32)
+    magnitude = np.abs(parts)
+    parts[magnitude < np.finfo(np.float32).eps * magnitude.max(axis=(-2, -1), keepdims=True)] = 0.0
+    return m
+
+
+def parity_bases(rows):
+    # Orthonormal even and odd combinations of mirror sites y and rows-1-y; the centre row of an
+    # odd-sized mesh is even on its own
+    half = rows // 2
+    even = np.zeros((rows, rows - half))
+    odd = np.zeros((rows, half))
+    for j in range(half):
+        even[j, j] = even[rows - 1 - j, j] = np.sqrt(0.5)
+        odd[j, j], odd[rows - 1 - j, j] = np.sqrt(0.5), -np.sqrt(0.5)
+    if rows % 2:
+        even[half, half] = 1.0
+    return [even, odd]
+
+
+class RecursionCache:
+    # Lead modes and forward slice states of earlier sweeps, for reuse by later sweeps that share
+    # the lead and a prefix of the potential columns. States are kept every interval-th slice.
+    # Beyond max_bytes the least recently used entries of earlier solvers are dropped; entries
+    # of the current solver are never evicted for each other, so a large sweep keeps what fits
+    # instead of cycling through the cache
+    def __init__(self, interval=16, max_bytes=RECURSION_CACHE_BYTES):
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.generation = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries[key] = (entry[0], self.generation, entry[2])
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        if key in self.entries:
+            return
+        nbytes = sum(part.nbytes for part in value if isinstance(part, np.ndarray))
+        while self.entries and self.nbytes + nbytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            _, generation, size = self.entries[oldest]
+            if generation == self.generation:
+                return
+            del self.entries[oldest]
+            self.nbytes -= size
+        if nbytes <= self.max_bytes:
+            self.entries[key] = (value, self.generation, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+class UsukiSolver:
+    def __init__(self, potential_vals, ny, xmin, xmax, ymin, ymax, b=B, checkpoint=None, transmission_only=False,
+                 instrument=None, cancel=None, batch=None, single=False, single_tol=SINGLE_TOL, backend="recursion",
+                 parity=True, recursion_cache=None, journal=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+        if backend == "sparse" and sparse is None:
+            raise ImportError("the sparse backend needs scipy")
+        self.rows = ny
+        self.xmin = xmin
+        self.xmax = xmax
+        self.ymin = ymin
+        self.ymax = ymax
+        self.dely = (ymax-ymin)/(ny+1)
+        self.delx = self.dely
+        self.thop = 1.0/(self.delx*self.delx*ANGFAC)
+        self.nsl = int(xmax/self.delx)
+        self.b = b
+        self.bet = Q * b * (A ** 2) / HBAR
+        self.pot = potential_columns(potential_vals, self.nsl, ny)
+        # Keep every checkpoint-th slice matrix and recompute the rest during backward propagation
+        self.checkpoint = checkpoint
+        # Only run the forward recursion and skip the slice store, backward pass and densities
+        self.transmission_only = transmission_only
+        self.instrument = instrument or Instrument()
+        # Energies advanced through each slice together as one (batch, rows, rows) stack
+        self.batch = batch
+        # Run the slices in complex64, falling back to complex128 for energies that fail the flux check
+        # (NaN included); the sparse backend always solves in complex128
+        self.single = single
+        self.single_tol = single_tol
+        # "recursion" walks the slices with dense rows x rows inversions; "sparse" factorizes the
+        # whole device once per energy, which scales better for wide meshes
+        self.backend = backend
+        # Anything with is_set(), e.g. a threading.Event; checked between energies and between chunks
+        self.cancel = cancel
+        # Transverse hopping within a slice; None is the plain nearest-neighbour chain
+        self.coupling = None
+        # Eigenpairs of the zero-field transverse lead matrix, filled in on first use
+        self.transverse = None
+        # Without a field a potential that is mirror-symmetric in y never mixes even and odd
+        # transverse states, so the problem splits into two independent halves
+        self.parity_blocks = None
+        if parity and self.bet == 0 and ny > 1 and np.array_equal(self.pot, self.pot[:, ::-1]):
+            self.parity_blocks = parity_bases(ny)
+        # A RecursionCache shared between solvers: re-runs restart the forward recursion at the last
+        # kept slice before the first changed column. Only used in-process, not by pool workers
+        self.recursion_cache = recursion_cache
+        if recursion_cache is not None:
+            recursion_cache.generation += 1
+        # A SweepJournal that every solved batch is saved to; energies already in it are not solved again
+        self.journal = journal
+
+    def __getstate__(self):
+        # Worker processes collect into a fresh instrument that the parent merges afterwards
+        state = self.__dict__.copy()
+        state["instrument"] = Instrument()
+        state["cancel"] = None
+        state["recursion_cache"] = None
+        state["journal"] = None
+        return state
+
+    def cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    def sweep(self, energies, workers=1):
+        energies = np.asarray(energies, dtype=float)
+        self.instrument.total = len(energies)
+        return self._collect(self._solve(energies, workers))
+
+    def adaptive_sweep(self, emax, frames, emin=0.0, coarse=None, tol=0.05, min_de=None, workers=1):
+        # Start from a coarse uniform grid and bisect intervals where the transmission or
+        # the number of open channels changes, until the frames budget is spent
+        coarse = coarse or max(2, frames // 4)
+        min_de = min_de or (emax - emin) / (16 * frames)
+        self.instrument.total = frames
+        # Like energy_grid, the grid starts one step above emin, where no channel is open
+        energies = np.linspace(emin, emax, min(coarse, frames) + 1)[1:]
+        results = dict(zip(energies, self._solve(energies, workers)))
+        while len(results) < frames and not self.cancelled():
+            energies = sorted(results)
+            candidates = []
+            for e0, e1 in zip(energies[:-1], energies[1:]):
+                if e1 - e0 < 2 * min_de:
+                    continue
+                (n0, t0, _, _), (n1, t1, _, _) = results[e0], results[e1]
+                change = max(abs(t1 - t0) / tol, abs(n1 - n0))
+                if change > 1.0 or n0 != n1:
+                    # Wide intervals with large changes are refined first
+                    candidates.append(((e1 - e0) * change, 0.5 * (e0 + e1)))
+            if not candidates:
+                break
+            candidates.sort(reverse=True)
+            midpoints = np.array(sorted(mid for _, mid in candidates[:frames - len(results)]))
+            results.update(zip(midpoints, self._solve(midpoints, workers)))
+        energies = np.array(sorted(results))
+        transmissions, densities = self._collect([results[en] for en in energies])
+        return energies, transmissions, densities
+
+    def _solve(self, energies, workers=1):
+        if self.journal is None:
+            return self._solve_new(energies, workers)
+        # Journaled energies are replayed through the instrument and only the rest are solved;
+        # a cancelled run still returns a prefix of the energies in order
+        done = [self.journal.get(en) for en in energies]
+        missing = np.array([en for en, result in zip(energies, done) if result is None])
+        self.instrument.count("journaled", len(energies) - len(missing))
+        for en, result in zip(energies, done):
+            if result is not None:
+                nprop, trans, ref, _ = result
+                self.instrument.record(energy=float(en), nprop=nprop, trans=trans, ref=ref,
+                                       unitarity=nprop - trans - ref, wall=0.0)
+        solved = iter(self._solve_new(missing, workers) if len(missing) else [])
+        results = []
+        for result in done:
+            result = result or next(solved, None)
+            if result is None:
+                break
+            results.append(result)
+        return results
+
+    def _solve_new(self, energies, workers=1):
+        if workers is None or workers <= 1 or len(energies) <= 1:
+            return self._solve_chunk(energies)
+        # Contiguous chunks keep per-task pickling small; map() returns them in energy order
+        chunks = np.array_split(energies, min(len(energies), 4 * workers))
+        results = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for part, (chunk, state) in zip(chunks, pool.map(self._solve_chunk_state, chunks)):
+                results.extend(chunk)
+                self.instrument.merge(state)
+                if self.journal is not None and chunk:
+                    self.journal.record(part[:len(chunk)], chunk)
+                if self.cancelled():
+                    pool.shutdown(cancel_futures=True)
+                    break
+        return results
+
+    def _collect(self, results):
+        # Energies with no open channel repeat the previous energy's results, as the serial loop always has
+        trans = 0.0
+        density = np.full((self.nsl + 1, self.rows), 1e-10)
+        transmissions = np.zeros(len(results))
+        densities = None if self.transmission_only else np.zeros((len(results), self.nsl + 1, self.rows))
+        for k, (nprop, t, _, d) in enumerate(results):
+            if nprop >= 1:
+                trans, density = t, d
+            transmissions[k] = trans
+            if densities is not None:
+                densities[k] = density
+        return transmissions, densities
+
+    def _solve_chunk(self, energies):
+        # Lead modes are solved batch by batch so only one batch's mode matrices are ever held
+        size = self.batch or 1
+        results = []
+        for start in range(0, len(energies), size):
+            if self.cancelled():
+                break
+            part = energies[start:start + size]
+            solved = self.solve_batch(part, self.lead_modes(part))
+            if self.journal is not None:
+                self.journal.record(part, solved)
+            results.extend(solved)
+        return results
+
+    def _solve_chunk_state(self, energies):
+        results = self._solve_chunk(energies)
+        return results, self.instrument.state()
+
+    def _block(self, basis):
+        # A solver for one parity block: the potential at one site of each mirror pair and the
+        # chain hopping projected onto the block
+        block = copy.copy(self)
+        block.rows = basis.shape[1]
+        block.pot = self.pot[:, np.abs(basis).argmax(axis=0)]
+        chain = np.eye(self.rows, k=1) + np.eye(self.rows, k=-1)
+        block.coupling = basis.T @ chain @ basis
+        block.parity_blocks = None
+        block.transverse = None
+        return block
+
+    def lead_modes(self, energies):
+        with self.instrument.phase("lead"):
+            if self.parity_blocks is None:
+                return self._cached_lead_modes(energies)
+            # Each energy gets its total open channels and the modes of every block
+            per_block = [self._block(basis)._cached_lead_modes(energies) for basis in self.parity_blocks]
+            return [(sum(modes[0] for modes in block_modes), block_modes) for block_modes in zip(*per_block)]
+
+    def _lead_hash(self):
+        # Everything the lead modes depend on besides the energy
+        h = hashlib.sha1(np.array([self.rows, self.thop, self.bet, self.delx], dtype=float).tobytes())
+        h.update(np.ascontiguousarray(self.pot[0]/self.thop).tobytes())
+        if self.coupling is not None:
+            h.update(self.coupling.tobytes())
+        return h
+
+    def _prefix_keys(self, dtype):
+        # Key of the forward state before slice ii: the lead, the precision and columns 0..ii-1
+        h = self._lead_hash()
+        h.update(np.dtype(dtype).str.encode())
+        keys = [h.hexdigest()]
+        for column in self.pot:
+            h.update(np.ascontiguousarray(column).tobytes())
+            keys.append(h.hexdigest())
+        return keys
+
+    def _cached_lead_modes(self, energies):
+        cache = self.recursion_cache
+        if cache is None:
+            return self._lead_modes(energies)
+        key = self._lead_hash().hexdigest()
+        modes = [cache.get((key, float(en))) for en in energies]
+        missing = [k for k, mode in enumerate(modes) if mode is None]
+        self.instrument.count("cached_leads", len(modes) - len(missing))
+        if missing:
+            for k, mode in zip(missing, self._lead_modes(np.asarray(energies, dtype=float)[missing])):
+                modes[k] = mode
+                cache.put((key, float(energies[k])), mode)
+        return modes
+
+    def _lead_modes(self, energies):
+        rows = self.rows
+        ehop = np.asarray(energies, dtype=float)/self.thop
+        if self.bet == 0:
+            evals, rnorm, cur, columns = self._transverse_lead(ehop)
+        else:
+            evals, rnorm, cur, columns = self._dense_lead(ehop)
+
+        # Classify every eigenvalue of every energy at once
+        x = np.abs(evals)
+        rk = np.angle(evals)
+        vf = np.divide(cur, rnorm, out=np.zeros_like(cur), where=rnorm != 0)
+        prop = (x > 0.9999) & (x < 1.0001)
+        right = prop & (vf > 0.0)
+        left = prop & ~(vf > 0.0)
+        decaying = x < 0.9999
+        growing = x > 1.0001
+        scale = np.sqrt(self.delx * self.delx * rnorm)
+
+        modes = []
+        for k in range(len(ehop)):
+            ipv = np.flatnonzero(right[k])
+            imv = np.flatnonzero(left[k])
+            ipev = np.flatnonzero(decaying[k])
+            imev = np.flatnonzero(growing[k])
+
+            # Propagating modes ascending (right-moving) and descending (left-moving) in wavenumber
+            ipv = ipv[np.argsort(rk[k, ipv])]
+            imv = imv[np.argsort(-rk[k, imv])]
+            pos = np.concatenate([ipv, ipev])
+            neg = np.concatenate([imv, imev])
+            if len(pos) != rows or len(neg) != rows:
+                raise ValueError(f"lead mode classification failed at energy {ehop[k] * self.thop:.6e}: "
+                                 f"{len(pos)} right-going and {len(neg)} left-going modes for {rows} rows "
+                                 f"(field b={self.b})")
+
+            vel = cur[k, ipv] / rnorm[k, ipv]
+            up = np.zeros((rows, rows), dtype=np.complex128)
+            upl = np.zeros((rows, rows), dtype=np.complex128)
+            um = np.zeros((rows, rows), dtype=np.complex128)
+            uml = np.zeros((rows, rows), dtype=np.complex128)
+            top, bottom = columns(k, pos)
+            up[:, :len(pos)] = top / scale[k, pos]
+            upl[:, :len(pos)] = bottom / scale[k, pos]
+            top, bottom = columns(k, neg)
+            um[:, :len(neg)] = top / scale[k, neg]
+            uml[:, :len(neg)] = bottom / scale[k, neg]
+            modes.append((np.count_nonzero(prop[k]) // 2, vel, up, upl, um, uml))
+        return modes
+
+    def _dense_lead(self, ehop):
+        rows = self.rows
+        bet = self.bet
+        idx = np.arange(rows)
+
+        # Stack the lead transfer matrices Tl = [[0, 1], [T21, T22]] for every energy
+        Pmi = -np.exp(1j * bet)
+        Tl = np.zeros((len(ehop), 2*rows, 2*rows), dtype=np.complex128)
+        Tl[:, idx, idx + rows] = 1.0
+        Tl[:, idx + rows, idx] = -Pmi * Pmi
+        Tl[:, idx + rows, idx + rows] = (ehop[:, np.newaxis] - 4.0 - self.pot[0]/self.thop) * Pmi
+        Tl[:, idx[:-1] + rows, idx[1:] + rows] = -Pmi
+        Tl[:, idx[1:] + rows, idx[:-1] + rows] = -Pmi
+
+        evals, evec = np.linalg.eig(Tl)
+
+        weight = np.abs(evec[:, :rows, :])**2
+        rnorm = np.sum(weight, axis=1)
+        phase = np.angle(evals)[:, np.newaxis, :] + 2.0 * np.pi * bet * (idx[np.newaxis, :, np.newaxis] + 1)
+        cur = np.sum(np.sin(phase) * weight, axis=1)
+
+        def columns(k, js):
+            return evec[k, :rows, js].T, evec[k, rows:, js].T
+        return evals, rnorm, cur, columns
+
+    def _transverse_lead(self, ehop):
+        # Without a magnetic phase T22 = (4 - ehop) + K with the energy-independent transverse
+        # matrix K = diag(V) + offdiag(1), so an eigenvector phi of K with eigenvalue kappa gives
+        # the Bloch pair [phi, lam*phi] of Tl with lam + 1/lam = kappa + 4 - ehop
+        rows = self.rows
+        if self.transverse is None:
+            # K is the same for every energy, so it is diagonalized once per solver
+            lead = self.pot[0]/self.thop
+            if self.coupling is None and np.all(lead == lead[0]):
+                k = np.arange(1, rows + 1)
+                kappa = lead[0] + 2.0 * np.cos(np.pi * k / (rows + 1))
+                phi = np.sqrt(2.0 / (rows + 1)) * np.sin(np.pi * np.outer(np.arange(1, rows + 1), k) / (rows + 1))
+            else:
+                chain = np.eye(rows, k=1) + np.eye(rows, k=-1) if self.coupling is None else self.coupling
+                kappa, phi = np.linalg.eigh(np.diag(lead) + chain)
+            self.transverse = kappa, phi
+        kappa, phi = self.transverse
+
+        mu = (kappa[np.newaxis, :] + 4.0 - ehop[:, np.newaxis]).astype(np.complex128)
+        root = np.sqrt(mu * mu - 4.0)
+        # Take the larger-magnitude root directly and the other as its reciprocal for stability
+        lam = 0.5 * (mu + np.where((mu.conj() * root).real >= 0, root, -root))
+        evals = np.concatenate([lam, 1.0 / lam], axis=1)
+        rnorm = np.ones(evals.shape)
+        cur = np.sin(np.angle(evals))
+
+        def columns(k, js):
+            return phi[:, js % rows], evals[k, js] * phi[:, js % rows]
+        return evals, rnorm, cur, columns
+
+    def solve_energy(self, en, modes=None):
+        if modes is None:
+            modes = self.lead_modes([en])[0]
+        return self.solve_batch([en], [modes])[0]
+
+    def solve_batch(self, energies, modes):
+        instrument = self.instrument
+        start = instrument.timer()
+        results = self._solve_modes(energies, modes)
+        for _, _, _, density in results:
+            if density is not None:
+                density[density < 1e-10] = 1e-10
+        wall = (instrument.timer() - start) / len(energies)
+        for en, (nprop, trans, ref, _) in zip(energies, results):
+            instrument.count("energies")
+            if nprop < 1:
+                instrument.count("closed")
+            instrument.record(energy=float(en), nprop=int(nprop), trans=float(trans), ref=float(ref),
+                              unitarity=float(nprop - trans - ref), wall=wall)
+        return results
+
+    def _solve_modes(self, energies, modes):
+        # Energies with no open channel are skipped; the rest advance through the slices together
+        results = [(mode[0], 0.0, 0.0, None) for mode in modes]
+        active = [k for k, mode in enumerate(modes) if mode[0] >= 1]
+        if active:
+            stack = np.array([energies[k] for k in active])
+            stack_modes = [modes[k] for k in active]
+            if self.parity_blocks is not None:
+                solved = self._solve_parity(stack, stack_modes)
+            elif self.backend == "sparse":
+                solved = self._solve_sparse(stack, stack_modes)
+            else:
+                solved = self._solve_stack(stack, stack_modes, np.complex64 if self.single else np.complex128)
+            if self.single and self.backend == "recursion" and self.parity_blocks is None:
+                redo = [k for k, (nprop, trans, ref, _) in enumerate(solved)
+                        if not abs(nprop - trans - ref) <= self.single_tol]
+                if redo:
+                    self.instrument.count("fallback", len(redo))
+                    for k, result in zip(redo, self._solve_stack(stack[redo], [stack_modes[k] for k in redo])):
+                        solved[k] = result
+            for k, result in zip(active, solved):
+                results[k] = result
+        return results
+
+    def _solve_parity(self, energies, modes):
+        # Channels, transmission and reflection add over the blocks; a block state phi puts
+        # |phi_j|^2 / 2 on both sites of mirror pair j (all of it on a centre row)
+        results = [[0, 0.0, 0.0, None] for _ in energies]
+        for k, basis in enumerate(self.parity_blocks):
+            weights = (basis != 0) / np.count_nonzero(basis, axis=0)
+            solved = self._block(basis)._solve_modes(energies, [mode[1][k] for mode in modes])
+            for result, (nprop, trans, ref, density) in zip(results, solved):
+                result[0] += nprop
+                result[1] += trans
+                result[2] += ref
+                if not self.transmission_only:
+                    full = 0.0 if density is None else density @ weights.T
+                    result[3] = full if result[3] is None else result[3] + full
+        return [tuple(result) for result in results]
+
+    def _solve_stack(self, energies, modes, dtype=np.complex128):
+        rows = self.rows
+        nsl = self.nsl
+        stride = self.checkpoint or 1
+        instrument = self.instrument
+        nb = len(energies)
+
+        nprop = [mode[0] for mode in modes]
+        vel = [mode[1] for mode in modes]
+        up, upl, um, uml = (np.stack([mode[i] for mode in modes]).astype(dtype, copy=False) for i in range(2, 6))
+        ehop = energies/self.thop
+
+        # Forward slice states before slice ii, kept for every stride-th slice only
+        store = not self.transmission_only
+        anchors = []
+        cache = self.recursion_cache
+        keys = self._prefix_keys(dtype) if cache is not None else None
+
+        with instrument.phase("forward"):
+            start, resumed = self._resume(energies, keys, store) if cache is not None else (0, [])
+            if start:
+                _, c1l1, c2l1, d1l1, d2l1 = resumed[-1]
+                anchors = [(ii, c1, c2) for ii, c1, c2, _, _ in resumed[:-1]]
+            else:
+                d2l1 = np.linalg.inv(uml)
+                c2l1 = um @ d2l1
+                d1l1 = -d2l1 @ upl
+                c1l1 = up - c2l1 @ upl
+            for ii in range(start, nsl+1):
+                if cache is not None and ii % cache.interval == 0:
+                    for k, en in enumerate(energies):
+                        cache.put((keys[ii], float(en)), (c1l1[k].copy(), c2l1[k].copy(), d1l1[k].copy(),
+                                                          d2l1[k].copy()))
+                if store and (ii % stride == 0 or ii == start):
+                    anchors.append((ii, c1l1, c2l1))
+                d1l = d1l1
+                d2l = d2l1
+                c1l1, c2l1 = self._slice(ii, ehop, c1l1, c2l1)
+                d2l1 = flush(d2l @ c2l1)
+                save = d2l @ c1l1
+                d1l1 = flush(d1l + save)
+        instrument.count("slices", nb * (nsl + 1 - start))
+        instrument.count("reused", nb * start)
+
+        with instrument.phase("final"):
+            c1l = c1l1
+            c2l = c2l1
+            d1l = d1l1
+            d2l = d2l1
+            # final slice
+            upli = np.linalg.inv(upl)
+            save = up @ upli
+            save2 = c2l - save
+            p2 = np.linalg.inv(save2)
+            save2 = p2 @ c1l
+            p1 = -save2
+            save = upli @ save2
+            c1l1 = -save
+            save = d2l @ save2
+            d1l1 = d1l - save
+
+            # Flux sums are always accumulated in double precision
+            c1l1 = c1l1.astype(np.complex128, copy=False)
+            d1l1 = d1l1.astype(np.complex128, copy=False)
+            results = []
+            for k in range(nb):
+                trans = 0.0
+                ref = 0.0
+                for j in range(nprop[k]):
+                    for i in range(nprop[k]):
+                        term = (vel[k][i] / vel[k][j]) * abs(c1l1[k, i, j])**2
+                        trans += term
+                        ref += (vel[k][i] / vel[k][j]) * abs(d1l1[k, i, j])**2
+                results.append((nprop[k], trans, ref, None))
+
+        if not store:
+            return results
+
+        # Backward propagation, recomputing each segment between stored slices; only the
+        # nprop open columns of each energy contribute to its density
+        with instrument.phase("backward"):
+            open_cols = (np.arange(rows)[np.newaxis, :] < np.array(nprop)[:, np.newaxis])[:, np.newaxis, :]
+            psipm = np.zeros((nb, nsl + 1, rows), dtype=np.double)
+            phi1new = c1l + c2l @ p1
+            psipm[:, nsl] = np.sum(np.abs(phi1new)**2 * open_cols, axis=2)
+            ends = [ii for ii, _, _ in anchors[1:]] + [nsl + 1]
+            for (base, c1, c2), end in zip(reversed(anchors), reversed(ends)):
+                c1s = [c1]
+                c2s = [c2]
+                for ii in range(base, end - 1):
+                    c1, c2 = self._slice(ii, ehop, c1s[-1], c2s[-1])
+                    c1s.append(c1)
+                    c2s.append(c2)
+                instrument.count("recomputed", nb * (len(c1s) - 1))
+                for lplot in range(base + len(c1s) - 1, max(base, 1) - 1, -1):
+                    phi1new = flush(c1s[lplot - base] + c2s[lplot - base] @ phi1new)
+                    psipm[:, lplot - 1] = np.sum(np.abs(phi1new)**2 * open_cols, axis=2)
+
+        return [(n, trans, ref, density) for (n, trans, ref, _), density in zip(results, psipm)]
+
+    def _resume(self, energies, keys, store):
+        # The latest kept slice whose forward state is cached for every energy of the batch. The
+        # backward pass restarts its segments from the kept states before it, so with densities
+        # every kept state up to the resume point must be cached as well
+        cache = self.recursion_cache
+        points = range(0, self.nsl + 1, cache.interval)
+        held = [all((keys[ii], float(en)) in cache for en in energies) for ii in points]
+        if store:
+            needed = list(points[:held.index(False) if False in held else len(held)])
+        else:
+            needed = [ii for ii, ok in zip(points, held) if ok][-1:]
+        if not needed or needed[-1] == 0:
+            return 0, []
+        states = []
+        for ii in needed:
+            parts = zip(*(cache.get((keys[ii], float(en))) for en in energies))
+            states.append((ii, *(np.stack(stack) for stack in parts)))
+        return needed[-1], states
+
+    def _solve_sparse(self, energies, modes):
+        # The slice equations T21 psi[x-1] + T22[x] psi[x] - psi[x+1] = 0 for every slice at once, closed
+        # by the leads: psi[nsl+1] = upl up^-1 psi[nsl] on the right, and on the left psi[-1] follows
+        # from psi[0] and the incident modes through um uml^-1. Solved for all incident modes together.
+        rows = self.rows
+        n = self.nsl + 1
+        size = n * rows
+        instrument = self.instrument
+        Pmi = complex(-np.exp(1j * self.bet))
+        T21 = -Pmi * Pmi
+
+        k = np.arange(size)
+        chain = np.eye(rows, k=1) + np.eye(rows, k=-1) if self.coupling is None else self.coupling
+        hop_r, hop_c = np.nonzero(chain)
+        offset = (rows * np.arange(n))[:, np.newaxis]
+        across_r, across_c = (offset + hop_r).ravel(), (offset + hop_c).ravel()
+        block_r, block_c = (i.ravel() for i in np.meshgrid(np.arange(rows), np.arange(rows), indexing='ij'))
+        pattern_r = np.concatenate([k, across_r, k[rows:], k[:-rows], block_r, size - rows + block_r])
+        pattern_c = np.concatenate([k, across_c, k[:-rows], k[rows:], block_c, size - rows + block_c])
+        couplings = np.concatenate([np.tile(-Pmi * chain[hop_r, hop_c], n), np.full(size - rows, T21),
+                                    np.full(size - rows, -1.0)])
+
+        results = []
+        for en, (nprop, vel, up, upl, um, uml) in zip(energies, modes):
+            with instrument.phase("assemble"):
+                umli = um @ np.linalg.inv(uml)
+                upli = up @ np.linalg.inv(upl)
+                diagonal = ((en/self.thop - 4.0 - self.pot[:n]) * Pmi).ravel()
+                right = -upl @ np.linalg.inv(up)
+                values = np.concatenate([diagonal, couplings, (T21 * umli).ravel(), right.ravel()])
+                # Duplicate entries on the two lead blocks are summed by the conversion
+                matrix = sparse.csc_matrix((values, (pattern_r, pattern_c)), shape=(size, size))
+                incident = up[:, :nprop]
+                rhs = np.zeros((size, nprop), dtype=np.complex128)
+                rhs[:rows] = -T21 * (upli - umli) @ incident
+            with instrument.phase("factor"):
+                lu = splu(matrix)
+            with instrument.phase("solve"):
+                psi = lu.solve(rhs).reshape(n, rows, nprop)
+
+            outgoing = np.linalg.solve(up, psi[-1])[:nprop]
+            reflected = np.linalg.solve(um, psi[0] - incident)[:nprop]
+            ratio = vel[:, np.newaxis] / vel[np.newaxis, :]
+            trans = float(np.sum(ratio * np.abs(outgoing)**2))
+            ref = float(np.sum(ratio * np.abs(reflected)**2))
+            density = None
+            if not self.transmission_only:
+                density = np.sum(np.abs(psi)**2, axis=2)
+            results.append((nprop, trans, ref, density))
+        instrument.count("factorizations", len(energies))
+        return results
+
+    def _slice(self, ii, ehop, c1l, c2l):
+        # Advances a stack of energies through slice ii: ehop is (nb,), c1l and c2l are (nb, rows, rows)
+        # and set the working precision
+        rows = self.rows
+        idx = np.arange(rows)
+        Pmi = complex(-np.exp(1j * self.bet))
+        T21 = -Pmi * Pmi
+        T22 = np.zeros((len(ehop), rows, rows), dtype=c2l.dtype)
+        if self.coupling is None:
+            T22[:, idx[:-1], idx[1:]] = -Pmi
+            T22[:, idx[1:], idx[:-1]] = -Pmi
+        else:
+            T22[:] = -Pmi * self.coupling
+        T22[:, idx, idx] += (ehop[:, np.newaxis] - 4.0 - self.pot[ii]) * Pmi
+        p2i = T21 * c2l + T22
+        c2l1 = flush(np.linalg.inv(p2i))
+        c1l1 = -(c2l1 @ (T21 * c1l))
+        return flush(c1l1), flush(c2l1)